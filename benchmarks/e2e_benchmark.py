@@ -0,0 +1,224 @@
+"""
+Runs main.py end to end against the mock Overgrad API and the in-memory cloud storage and BigQuery fakes, and
+reports records/sec, requests/sec and peak RSS per workflow. Each workflow runs in its own subprocess so peak RSS
+is its own; state, logs and uploads never leave a temporary directory.
+
+The delete-* workflows check the deletion safeguards as well as timing them: a deletion above DELETE_MAX_RATIO is
+refused, --dry-run only warns about it, and --incremental skips the full API scan when the sampled pages match
+the last one. A workflow whose outcome is not the expected one is reported as FAILED.
+
+Run from the repo root: python -m benchmarks.e2e_benchmark --records 2000 --latency 0.02
+Any of the connector's tuning variables (OVERGRAD_MAX_WORKERS, UPLOAD_WORKERS, ...) can be set in the environment;
+STORAGE_BACKEND=memory takes output I/O out of the measurement altogether.
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Union
+
+from benchmarks.mock_overgrad_api import MockOvergradAPI, YEAR_ID_BLOCK
+from utils import serializers
+
+
+WORKFLOWS = {
+    "updates": [],
+    "sharded": ["--sharded-output"],
+    "parquet": ["--output-format", "parquet"],
+    "delete": ["--delete-records"],
+    "delete-threshold": ["--delete-records"],
+    "delete-dry-run": ["--delete-records", "--dry-run"],
+    "delete-incremental": ["--delete-records", "--incremental"],
+}
+# Share of extra warehouse IDs the delete workflows find missing from the API; kept under DELETE_MAX_RATIO except
+# for the workflows that check a deletion above it is refused
+DELETED_SHARE = 0.05
+OVER_THRESHOLD_SHARE = 0.5
+# Whether each delete workflow must report a failure, and whether the files of the records missing from the API
+# must still be there afterwards
+EXPECTED_DELETE_OUTCOMES = {
+    "delete": (False, False),
+    "delete-threshold": (True, True),
+    "delete-dry-run": (False, True),
+    "delete-incremental": (False, False),
+}
+RESULT_PREFIX = "BENCHMARK_RESULT "
+
+
+def _seed_deleted_records(workflow: str, grad_years: list, records: int) -> list:
+    """
+    Adds warehouse IDs the API does not return, and a file for each, for the delete workflows to find; returns the
+    names of those files
+    """
+    from benchmarks import fakes
+    from entities.endpoints import create_endpoint_object
+    from utils import helpers
+    from utils.config import OVERGRAD_ENDPOINT_CONFIGS
+    from utils.storage import storage
+    share = OVER_THRESHOLD_SHARE if workflow in ("delete-threshold", "delete-dry-run") else DELETED_SHARE
+    extra = int(records * share)
+    blob_names = []
+    for config in OVERGRAD_ENDPOINT_CONFIGS:
+        if config["name"] not in ("admissions", "followings", "students"):
+            continue
+        endpoint = create_endpoint_object(config)
+        fakes.tables[f"stg_og__{endpoint.name}"] = [
+            {"id": int(year) * YEAR_ID_BLOCK + i, "graduation_year": int(year)}
+            for year in grad_years for i in range(1, records + extra + 1)
+        ]
+        if workflow in EXPECTED_DELETE_OUTCOMES:
+            extension = serializers.NDJSON_EXTENSIONS[endpoint.compression]
+            blob_names.extend(
+                f"{helpers.gcs_folder(endpoint, year)}/{endpoint.file_name_prefix}_{int(year) * YEAR_ID_BLOCK + i}"
+                f"{extension}"
+                for year in grad_years for i in range(records + 1, records + extra + 1)
+            )
+    for blob_name in blob_names:
+        storage().upload(blob_name, b"{}")
+    return blob_names
+
+
+def _run_child(workflow: str, grad_years: list, records: int) -> None:
+    """Runs main.py in this process; prints the elapsed time and peak RSS on the last line of stdout"""
+    from benchmarks import fakes
+    fakes.install()
+    os.chdir(tempfile.mkdtemp(prefix="overgrad-benchmark-"))
+    deleted_blobs = _seed_deleted_records(workflow, grad_years, records)
+
+    start = time.perf_counter()
+    import main as connector
+    from utils.storage import storage
+    connector._configure(["--grad-year", ",".join(grad_years), *WORKFLOWS[workflow]])
+    connector.main()
+    elapsed = time.perf_counter() - start
+
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    peak_rss_mb = peak_rss / (1024 * 1024) if sys.platform == "darwin" else peak_rss / 1024
+    result = {
+        "elapsed": elapsed,
+        "peak_rss_mb": peak_rss_mb,
+        "failed": not connector.notifications.exception_stack_empty,
+        "blobs": len(storage().list("overgrad/")),
+        "deleted_blobs": len(deleted_blobs),
+        "deleted_blobs_left": sum(1 for blob_name in deleted_blobs if storage().download(blob_name) is not None),
+    }
+    print(RESULT_PREFIX + json.dumps(result), flush=True)
+
+
+def _run_child_process(workflow: str, env: dict, args: argparse.Namespace) -> dict:
+    completed = subprocess.run(
+        [sys.executable, "-m", "benchmarks.e2e_benchmark", "--child", workflow,
+         "--grad-years", args.grad_years, "--records", str(args.records)],
+        env=env,
+        capture_output=True,
+        text=True,
+    )
+    lines = [line for line in completed.stdout.splitlines() if line.startswith(RESULT_PREFIX)]
+    if completed.returncode != 0 or not lines:
+        sys.stderr.write(completed.stdout[-4000:] + completed.stderr[-4000:])
+        raise RuntimeError(f"The {workflow} workflow exited with {completed.returncode}")
+    return json.loads(lines[-1][len(RESULT_PREFIX):])
+
+
+def _unexpected_outcome(workflow: str, result: dict, full_scan_records: int) -> Union[None, str]:
+    """Why a workflow did not end the way it should, or None if it did"""
+    expect_failure, expect_files_left = EXPECTED_DELETE_OUTCOMES.get(workflow, (False, None))
+    if result["failed"] != expect_failure:
+        return "the run reported a failure" if result["failed"] else "the run did not refuse the deletion"
+    if expect_files_left is not None:
+        expected_left = result["deleted_blobs"] if expect_files_left else 0
+        if result["deleted_blobs_left"] != expected_left:
+            return f"{result['deleted_blobs_left']} of {result['deleted_blobs']} deleted records' files left"
+    if workflow == "delete-incremental" and result["records"] >= full_scan_records:
+        return f"fetched {result['records']} records, as many as a full scan"
+    return None
+
+
+def _run_workflow(api: MockOvergradAPI, workflow: str, args: argparse.Namespace) -> dict:
+    env = {
+        **os.environ,
+        "OVERGRAD_API_URL": api.url,
+        "OVERGRAD_API_KEY": "benchmark",
+        "BUCKET": "benchmark",
+        "GBQ_DATASET": "benchmark",
+        "GBQ_PROJECT": "benchmark",
+    }
+    env["STATE_DIR"] = tempfile.mkdtemp(prefix="overgrad-benchmark-state-")
+    # The production limit would make the benchmark measure the rate limiter rather than the connector
+    env.setdefault("OVERGRAD_REQUESTS_PER_SECOND", "1000")
+    env.setdefault("OVERGRAD_BURST", "10")
+
+    if workflow == "delete-incremental":
+        # The full scan whose API IDs the incremental run compares against; not measured
+        _run_child_process("delete", env, args)
+
+    api.reset_counts()
+    result = _run_child_process(workflow, env, args)
+    result.update({
+        "workflow": workflow,
+        "requests": api.request_count,
+        "records": api.record_count,
+        "rate_limited": api.rate_limited_count,
+        "dropped": api.dropped_count,
+        "records_per_sec": api.record_count / result["elapsed"],
+        "requests_per_sec": api.request_count / result["elapsed"],
+    })
+    # Each delete workflow scans the three endpoints the deletion workflow covers
+    full_scan_records = 3 * len(args.grad_years.split(",")) * args.records
+    result["unexpected"] = _unexpected_outcome(workflow, result, full_scan_records)
+    result["failed"] = result["unexpected"] is not None
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end benchmark against a mock Overgrad API")
+    parser.add_argument("--records", type=int, default=2000, help="Records per endpoint and grad year")
+    parser.add_argument("--grad-years", default="2026", help="Comma-separated grad years")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds the mock API adds to every response")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="Share of requests answered with a 429")
+    parser.add_argument(
+        "--drop-rate", type=float, default=0.0,
+        help="Share of connections dropped; the client retries them after a jittered backoff of up to "
+             "OVERGRAD_RETRY_MAX_WAIT seconds, so keep it low or lower that variable"
+    )
+    parser.add_argument("--workflows", default="updates,delete", help=f"Any of {', '.join(WORKFLOWS)}")
+    parser.add_argument("--json", dest="json_path", default=None, help="Also writes the results to this JSON file")
+    parser.add_argument("--child", default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    grad_years = args.grad_years.split(",")
+    if args.child is not None:
+        _run_child(args.child, grad_years, args.records)
+        return
+
+    results = []
+    with MockOvergradAPI(
+            records=args.records,
+            latency=args.latency,
+            rate_limit_rate=args.rate_limit_rate,
+            drop_rate=args.drop_rate
+    ) as api:
+        for workflow in args.workflows.split(","):
+            result = _run_workflow(api, workflow, args)
+            results.append(result)
+            print(
+                f"{workflow:<18} {result['elapsed']:7.2f}s | {result['records_per_sec']:8.0f} records/s "
+                f"| {result['requests_per_sec']:6.1f} requests/s | peak RSS {result['peak_rss_mb']:6.1f} MB "
+                f"| {result['rate_limited']} rate limited, {result['dropped']} dropped"
+                + (f" | FAILED: {result['unexpected']}" if result["failed"] else "")
+            )
+
+    if args.json_path is not None:
+        with open(args.json_path, "w") as f:
+            json.dump(results, f, indent=2)
+    if any(result["failed"] for result in results):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
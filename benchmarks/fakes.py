@@ -0,0 +1,180 @@
+"""
+In-memory stand-ins for gbq_connector's CloudStorageClient and BigQueryClient, covering the methods the connector
+uses, and for the google clients utils.clients builds itself. Every instance shares the same storage. Call
+install() before the connector creates its clients in utils.clients.
+"""
+from collections import namedtuple
+import re
+from threading import Lock, local
+from typing import Dict, List, Tuple
+
+import gbq_connector
+from gbq_connector.exceptions import CloudFileNotFoundError
+from google.api_core.exceptions import NotFound
+import pandas as pd
+
+from utils import batch_delete
+from utils import clients
+
+
+blobs: Dict[Tuple[str, str], bytes] = {}
+# BigQuery rows by table name; a query is answered with the rows of the first table named in it, limited to the
+# grad year in its "graduation_year = N" filter when the rows have a graduation_year
+tables: Dict[str, List[dict]] = {}
+_lock = Lock()
+
+_Response = namedtuple("_Response", "status_code")
+
+
+class _Blob:
+    def __init__(self, bucket: str, name: str):
+        self._key = (bucket, name)
+        self.name = name
+
+    def download_as_bytes(self) -> bytes:
+        with _lock:
+            if self._key not in blobs:
+                raise NotFound(self.name)
+            return blobs[self._key]
+
+    def exists(self) -> bool:
+        return self._key in blobs
+
+    def delete(self) -> None:
+        with _lock:
+            if blobs.pop(self._key, None) is None:
+                raise NotFound(self.name)
+
+
+class _Batch:
+    def __init__(self, client: "_StorageClient", raise_exception: bool = True):
+        self._client = client
+        self._deferred: List[Tuple[str, str]] = []
+        self.responses: List[_Response] = []
+
+    def __enter__(self):
+        self._client._batch.current = self
+        return self
+
+    def __exit__(self, exc_type, *exc_info):
+        self._client._batch.current = None
+        if exc_type is None:
+            self.finish()
+
+    def finish(self, raise_exception: bool = True) -> List[_Response]:
+        with _lock:
+            self.responses = [_Response(204 if blobs.pop(key, None) is not None else 404) for key in self._deferred]
+        return self.responses
+
+
+class _Bucket:
+    def __init__(self, client: "_StorageClient", name: str):
+        self._client = client
+        self.name = name
+
+    def blob(self, name: str) -> _Blob:
+        return _Blob(self.name, name)
+
+    def copy_blob(self, blob: _Blob, destination_bucket: "_Bucket", new_name: str) -> _Blob:
+        with _lock:
+            if blob._key not in blobs:
+                raise NotFound(blob.name)
+            blobs[(destination_bucket.name, new_name)] = blobs[blob._key]
+        return _Blob(destination_bucket.name, new_name)
+
+    def delete_blob(self, name: str) -> None:
+        batch = getattr(self._client._batch, "current", None)
+        if batch is not None:
+            batch._deferred.append((self.name, name))
+        else:
+            self.blob(name).delete()
+
+
+class _StorageClient:
+    def __init__(self):
+        self._batch = local()
+
+    def bucket(self, name: str) -> _Bucket:
+        return _Bucket(self, name)
+
+    def batch(self, raise_exception: bool = True) -> _Batch:
+        return _Batch(self, raise_exception)
+
+
+class FakeCloudStorageClient:
+    def load_in_memory_file_to_cloud(self, bucket: str, blob: str, file) -> None:
+        file.seek(0)
+        content = file.read()
+        with _lock:
+            blobs[(bucket, blob)] = content
+
+    def delete_file(self, bucket: str, blob: str) -> None:
+        with _lock:
+            if blobs.pop((bucket, blob), None) is None:
+                raise CloudFileNotFoundError(f"File '{blob}' not found in bucket '{bucket}'.")
+
+    def delete_folder(self, bucket: str, folder_prefix: str) -> None:
+        with _lock:
+            for key in [key for key in blobs if key[0] == bucket and key[1].startswith(folder_prefix)]:
+                del blobs[key]
+
+    def list_blobs(self, bucket: str, folder_prefix: str, file_extension: str = None) -> List[_Blob]:
+        return [
+            _Blob(bucket, name) for name in sorted(
+                name for blob_bucket, name in list(blobs)
+                if blob_bucket == bucket and name.startswith(folder_prefix)
+                and (file_extension is None or name.endswith(file_extension))
+            )
+        ]
+
+
+class _RowIterator:
+    def __init__(self, rows: List[dict], page_size: int):
+        # Only the ID is selected; graduation_year is just there to be filtered on
+        values = [tuple(value for column, value in row.items() if column != "graduation_year") for row in rows]
+        self.pages = [values[i:i + page_size] for i in range(0, len(values), page_size)]
+
+
+class _QueryJob:
+    def __init__(self, rows: List[dict]):
+        self._rows = rows
+
+    def result(self, page_size: int = 10000) -> _RowIterator:
+        return _RowIterator(self._rows, page_size)
+
+
+class _BigQueryClient:
+    def query(self, query: str) -> _QueryJob:
+        return _QueryJob(_rows_for(query))
+
+
+def _rows_for(query: str) -> List[dict]:
+    rows = next((rows for table, rows in tables.items() if table in query), [])
+    match = re.search(r"graduation_year\s*=\s*(\d+)", query)
+    if match is None:
+        return rows
+    year = int(match.group(1))
+    return [row for row in rows if row.get("graduation_year", year) == year]
+
+
+class FakeBigQueryClient:
+    def query(self, query: str):
+        rows = _rows_for(query)
+        return pd.DataFrame(rows) if rows else None
+
+    def get_table_as_df(self, table: str, dataset: str = None) -> pd.DataFrame:
+        return pd.DataFrame(tables.get(table, []))
+
+
+def install() -> None:
+    gbq_connector.CloudStorageClient = FakeCloudStorageClient
+    gbq_connector.BigQueryClient = FakeBigQueryClient
+    clients._build_bigquery_client = _BigQueryClient
+    clients._build_gcs_client = _StorageClient
+    batch_delete._batch_class = lambda: _Batch
+
+
+def reset() -> None:
+    with _lock:
+        blobs.clear()
+        tables.clear()
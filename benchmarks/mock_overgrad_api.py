@@ -0,0 +1,258 @@
+"""
+A local stand-in for the Overgrad API. Serves synthetic, deterministic pages for every endpoint in
+OVERGRAD_ENDPOINT_CONFIGS and single universities by ID, with optional latency, 429 responses and dropped
+connections. Point the connector at it with OVERGRAD_API_URL.
+
+Run on its own from the repo root: python -m benchmarks.mock_overgrad_api --port 8080
+"""
+import argparse
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import random
+import socket
+from threading import Lock, Thread
+import time
+from typing import Union
+from urllib.parse import parse_qs, urlparse
+
+from utils.config import OVERGRAD_ENDPOINT_CONFIGS
+from utils.watermarks import format_timestamp
+
+
+CONFIGS = {config["name"]: config for config in OVERGRAD_ENDPOINT_CONFIGS}
+# Endpoints filtered by grad year get their own block of IDs per year
+YEAR_ID_BLOCK = 1_000_000
+UPDATED_AT_START = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+
+def _updated_at(record_id: int) -> datetime:
+    """Records are a minute apart, in ID order within each grad year"""
+    return UPDATED_AT_START + timedelta(minutes=record_id % YEAR_ID_BLOCK)
+
+
+def _value(field: str, record_id: int, universities: int):
+    """Values are keyed by the flattened field name, so a nested university.id is generated as university_id"""
+    if field == "id":
+        return record_id
+    if field == "university_id":
+        return 1 + record_id % universities
+    if field.endswith("_id"):
+        return record_id % 997
+    if field.endswith("_at"):
+        return format_timestamp(_updated_at(record_id))
+    return f"{field}-{record_id}"
+
+
+def synthetic_record(endpoint: str, record_id: int, universities: int) -> dict:
+    """Builds a payload shaped like the real one from the endpoint's config: nested objects and custom fields included"""
+    config = CONFIGS[endpoint]
+    nested_fields = sorted(config.get("nested_fields") or [], key=len, reverse=True)
+    record = {}
+    for field in config["fields"]:
+        nested = next((n for n in nested_fields if field.startswith(f"{n}_")), None)
+        if nested is None:
+            record[field] = _value(field, record_id, universities)
+        else:
+            record.setdefault(nested, {})[field[len(nested) + 1:]] = _value(field, record_id, universities)
+    for nested in nested_fields:
+        record.setdefault(nested, None)
+    custom_field = config.get("custom_field")
+    if custom_field is not None:
+        record[custom_field["field_name"]] = [
+            {
+                field: _value(field, record_id * 10 + i, universities) for field in custom_field["fields"]
+            }
+            for i in range(2)
+        ]
+    record["unexpected_field"] = "dropped"
+    return record
+
+
+class MockOvergradAPI:
+    """
+    Runs the mock API on a background thread. `records` is the number of records per endpoint and grad year;
+    `rate_limit_rate` and `drop_rate` are the share of requests answered with a 429 or a closed connection.
+    """
+    def __init__(
+            self,
+            records: int = 1000,
+            universities: int = 300,
+            latency: float = 0.0,
+            rate_limit_rate: float = 0.0,
+            drop_rate: float = 0.0,
+            retry_after: float = 0.1,
+            seed: int = 0,
+            port: int = 0,
+            max_page_size: Union[int, None] = None
+    ):
+        self.records = records
+        # Pages larger than this are answered with a 422, like an API that caps its limit parameter
+        self.max_page_size = max_page_size
+        self.universities = universities
+        self.latency = latency
+        self.rate_limit_rate = rate_limit_rate
+        self.drop_rate = drop_rate
+        self.retry_after = retry_after
+        self.request_count = 0
+        self.record_count = 0
+        self.rate_limited_count = 0
+        self.dropped_count = 0
+        self._random = random.Random(seed)
+        self._lock = Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", port), self._handler())
+        self._server.daemon_threads = True
+        self._thread: Union[Thread, None] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/api/v1"
+
+    def reset_counts(self) -> None:
+        with self._lock:
+            self.request_count = self.record_count = self.rate_limited_count = self.dropped_count = 0
+
+    def start(self) -> "MockOvergradAPI":
+        self._thread = Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _outcome(self) -> str:
+        with self._lock:
+            self.request_count += 1
+            roll = self._random.random()
+            if roll < self.drop_rate:
+                self.dropped_count += 1
+                return "drop"
+            if roll < self.drop_rate + self.rate_limit_rate:
+                self.rate_limited_count += 1
+                return "rate_limit"
+            return "ok"
+
+    def _page(self, endpoint: str, query: dict) -> Union[dict, str, None]:
+        if endpoint not in CONFIGS:
+            return None
+        limit = int(query.get("limit", [100])[0])
+        if self.max_page_size is not None and limit > self.max_page_size:
+            return "too_large"
+        page = int(query.get("page", [1])[0])
+        grad_year = query.get("graduation_year", [None])[0]
+        first_id = (int(grad_year) * YEAR_ID_BLOCK if grad_year else 0) + 1
+        matching = range(first_id, first_id + self.records)
+        updated_after = query.get("updated_after", [None])[0]
+        if updated_after is not None:
+            # The filter is a YYYY-MM-DD date, as --updated-since sends it, and includes records updated that day. Records
+            # are updated in ID order, so those are the tail of the range.
+            after = datetime.strptime(updated_after, "%Y-%m-%d").replace(tzinfo=timezone.utc)
+            skipped = sum(1 for record_id in matching if _updated_at(record_id) < after)
+            matching = matching[skipped:]
+        total_pages = max(1, -(-len(matching) // limit))
+        start = (page - 1) * limit
+        ids = matching[start:start + limit]
+        with self._lock:
+            self.record_count += len(ids)
+        return {
+            "data": [synthetic_record(endpoint, record_id, self.universities) for record_id in ids],
+            "total_count": len(matching),
+            "total_pages": total_pages,
+            "current_page": page,
+        }
+
+    def _record(self, endpoint: str, record_id: str) -> Union[dict, None]:
+        if endpoint not in CONFIGS or not record_id.isdigit():
+            return None
+        with self._lock:
+            self.record_count += 1
+        return {"data": synthetic_record(endpoint, int(record_id), self.universities)}
+
+    def _handler(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def setup(self):
+                super().setup()
+                # Headers and body go out in separate writes; without this each response waits on a delayed ACK
+                self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+            def log_message(self, *args):
+                pass
+
+            def _send(self, status: int, body: bytes, headers: Union[dict, None] = None):
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                if api.latency:
+                    time.sleep(api.latency)
+                outcome = api._outcome()
+                if outcome == "drop":
+                    self.connection.shutdown(socket.SHUT_RDWR)
+                    self.close_connection = True
+                    return
+                if outcome == "rate_limit":
+                    self._send(429, b'{"error": "rate limited"}', {"Retry-After": str(api.retry_after)})
+                    return
+
+                url = urlparse(self.path)
+                parts = url.path.strip("/").split("/")[2:]
+                if len(parts) == 1:
+                    payload = api._page(parts[0], parse_qs(url.query))
+                elif len(parts) == 2:
+                    payload = api._record(*parts)
+                else:
+                    payload = None
+                if payload == "too_large":
+                    self._send(422, b'{"error": "limit is too large"}')
+                elif payload is None:
+                    self._send(404, b'{"error": "not found"}')
+                else:
+                    self._send(200, json.dumps(payload).encode("utf-8"))
+
+        return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serves a synthetic Overgrad API locally")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--records", type=int, default=1000, help="Records per endpoint and grad year")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds added to every response")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="Share of requests answered with a 429")
+    parser.add_argument("--drop-rate", type=float, default=0.0, help="Share of connections closed without a response")
+    parser.add_argument("--max-page-size", type=int, default=None, help="Largest limit accepted before a 422")
+    args = parser.parse_args()
+    api = MockOvergradAPI(
+        records=args.records,
+        latency=args.latency,
+        rate_limit_rate=args.rate_limit_rate,
+        drop_rate=args.drop_rate,
+        port=args.port,
+        max_page_size=args.max_page_size
+    )
+    print(f"Serving a mock Overgrad API at {api.url}")
+    api.start()
+    try:
+        api._thread.join()
+    except KeyboardInterrupt:
+        api.stop()
+
+
+if __name__ == "__main__":
+    main()
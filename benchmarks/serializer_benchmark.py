@@ -0,0 +1,40 @@
+"""
+Compares decoding a synthetic admissions API page with the standard library and with orjson, and checks that
+serializers.dumps_line stays byte-for-byte identical to json.dumps.
+
+Run from the repo root: python -m benchmarks.serializer_benchmark
+"""
+import json
+import random
+from timeit import timeit
+
+from benchmarks.transform_benchmark import _synthetic_admission
+from utils import serializers
+
+
+PAGES = 200
+
+
+def main():
+    random.seed(0)
+    records = [_synthetic_admission(i) for i in range(100)]
+    records[0]["application_source"] = "Común App ✓"
+    page = json.dumps({"data": records, "total_count": 100, "total_pages": 1}).encode("utf-8")
+
+    for record in records:
+        assert serializers.dumps_line(record) == json.dumps(record).encode("utf-8")
+
+    stdlib = timeit(lambda: json.loads(page.decode("utf-8")), number=PAGES) / PAGES * 1e3
+    print(f"decode stdlib {stdlib:6.3f} ms/page")
+    if serializers.orjson is not None:
+        fast = timeit(lambda: serializers.orjson.loads(page), number=PAGES) / PAGES * 1e3
+        print(f"decode orjson {fast:6.3f} ms/page | {stdlib / fast:4.1f}x")
+    else:
+        print("orjson is not installed")
+
+    encode = timeit(lambda: [serializers.dumps_line(r) for r in records], number=PAGES) / PAGES * 1e3
+    print(f"encode stdlib {encode:6.3f} ms/page")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+"""
+Measures the cost of starting the connector: importing main.py, and what importing gbq_connector would add if it
+were still imported eagerly. Each measurement runs in a fresh interpreter and the median is reported. Client
+construction is not measured since it needs Google credentials; utils.clients defers it to first use.
+
+Run from the repo root: python -m benchmarks.startup_benchmark
+"""
+import json
+from statistics import median
+import subprocess
+import sys
+
+
+RUNS = 5
+
+_MEASURE = """
+import json, sys, time
+start = time.perf_counter()
+{statement}
+elapsed = time.perf_counter() - start
+print(json.dumps({{
+    "elapsed": elapsed,
+    "gbq_connector": "gbq_connector" in sys.modules,
+    "bigquery": "google.cloud.bigquery" in sys.modules,
+}}))
+"""
+
+
+def _measure(statement: str) -> dict:
+    runs = []
+    for _ in range(RUNS):
+        completed = subprocess.run(
+            [sys.executable, "-c", _MEASURE.format(statement=statement)], capture_output=True, text=True, check=True
+        )
+        runs.append(json.loads(completed.stdout.splitlines()[-1]))
+    return {**runs[-1], "elapsed": median(run["elapsed"] for run in runs)}
+
+
+def main():
+    for label, statement in [
+        ("import main", "import main"),
+        ("import gbq_connector", "import gbq_connector"),
+    ]:
+        result = _measure(statement)
+        print(
+            f"{label:<22} {result['elapsed'] * 1000:7.1f} ms | gbq_connector loaded: {result['gbq_connector']} "
+            f"| BigQuery loaded: {result['bigquery']}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+"""
+Compares the per-record cost of the original transform path (nested field flattening followed by
+clean_record_fields) with the compiled Endpoint.transform, on synthetic students and admissions payloads.
+
+Run from the repo root: python -m benchmarks.transform_benchmark
+"""
+import copy
+import random
+from timeit import timeit
+
+from entities.endpoints import create_endpoint_object
+from utils.config import OVERGRAD_ENDPOINT_CONFIGS
+
+
+RECORDS = 2000
+REPEATS = 5
+
+
+def _legacy_transform(record: dict, endpoint) -> dict:
+    """The transform path as it was before Endpoint.transform"""
+    if endpoint.nested_fields is not None:
+        for nested_field in endpoint.nested_fields:
+            child_fields = record.pop(nested_field)
+            if child_fields:
+                record.update({f"{nested_field}_{field}": value for field, value in child_fields.items()})
+    missing_record_fields = [field for field in endpoint.fields if field not in record.keys()]
+    for field in missing_record_fields:
+        record[field] = None
+    return {k: v for k, v in record.items() if k in endpoint.fields}
+
+
+def _synthetic_student(record_id: int) -> dict:
+    return {
+        "id": record_id,
+        "object": "student",
+        "created_at": "2024-08-01T12:00:00Z",
+        "updated_at": "2025-01-15T08:30:00Z",
+        "email": f"student{record_id}@example.org",
+        "first_name": "First",
+        "last_name": "Last",
+        "external_student_id": str(100000 + record_id),
+        "graduation_year": 2026,
+        "assigned_counselor": {"id": 7, "first_name": "Coun", "last_name": "Selor", "email": "c@example.org"},
+        "academics": {
+            "unweighted_gpa": round(random.uniform(2, 4), 2),
+            "weighted_gpa": round(random.uniform(2, 4.5), 2),
+            "projected_act": 24,
+            "projected_sat": 1180,
+            "highest_act": 25,
+            "highest_sat": 1200,
+            "highest_psat_nmsqt": 1100,
+        },
+        "school": {"id": 3, "name": "KIPP High School"},
+        "telephone": "555-555-5555",
+        "address": "1 Main St",
+        "awards": "Honor roll",
+        "interests": "Biology, Music",
+        "custom_field_values": [{"custom_field_id": 1, "text": "value"}],
+        "unexpected_field": "dropped",
+    }
+
+
+def _synthetic_admission(record_id: int) -> dict:
+    award_letter_fields = [
+        field[len("award_letter_"):]
+        for field in next(c for c in OVERGRAD_ENDPOINT_CONFIGS if c["name"] == "admissions")["fields"]
+        if field.startswith("award_letter_")
+    ]
+    return {
+        "id": record_id,
+        "object": "admission",
+        "created_at": "2024-10-01T12:00:00Z",
+        "updated_at": "2025-03-01T09:00:00Z",
+        "student": {"id": record_id // 10, "external_id": str(100000 + record_id // 10)},
+        "university": {"id": 1000 + record_id % 300, "ipeds_id": str(110000 + record_id % 300)},
+        "applied_on": "2024-11-01",
+        "application_source": "Common App",
+        "due_date": {"date": "2025-01-01", "type": "Regular"},
+        "status": "accepted",
+        "status_updated_at": "2025-03-01T09:00:00Z",
+        "waitlisted": False,
+        "deferred": False,
+        "academic_fit": "target",
+        "probability_of_acceptance": 0.7,
+        "award_letter": {field: random.randint(0, 50000) for field in award_letter_fields},
+        "custom_field_values": [],
+    }
+
+
+def _benchmark(endpoint_name: str, generator) -> None:
+    config = next(c for c in OVERGRAD_ENDPOINT_CONFIGS if c["name"] == endpoint_name)
+    endpoint = create_endpoint_object(config)
+    records = [generator(i) for i in range(RECORDS)]
+    for record in records:
+        record.pop("custom_field_values")
+
+    for record in records:
+        assert endpoint.transform(record) == _legacy_transform(copy.deepcopy(record), endpoint)
+
+    # Copies are made up front so the legacy path, which mutates records, is not charged for them
+    legacy_batches = [copy.deepcopy(records) for _ in range(REPEATS)]
+    legacy = timeit(
+        lambda: [_legacy_transform(r, endpoint) for r in legacy_batches.pop()], number=REPEATS
+    )
+    compiled = timeit(lambda: [endpoint.transform(r) for r in records], number=REPEATS)
+
+    legacy_us = legacy / (RECORDS * REPEATS) * 1e6
+    compiled_us = compiled / (RECORDS * REPEATS) * 1e6
+    print(
+        f"{endpoint_name:<12} legacy {legacy_us:6.2f} us/record | compiled {compiled_us:6.2f} us/record "
+        f"| {legacy_us / compiled_us:4.1f}x"
+    )
+
+
+if __name__ == "__main__":
+    random.seed(0)
+    _benchmark("students", _synthetic_student)
+    _benchmark("admissions", _synthetic_admission)
@@ -0,0 +1,429 @@
+"""
+The Overgrad API clients, on asyncio. Every client in the process runs its requests on one event loop, kept on a
+background thread, through one httpx connection pool that uses HTTP/2 when the h2 package is installed, and
+takes its tokens from the process-wide rate limiter. Endpoints paged from different threads therefore share the
+loop, the pool and the rate limit.
+
+The workflows use the sync classes in entities/overgrad_api.py, which drive the async generators here from their
+own threads with run_blocking and iterate_blocking.
+"""
+from abc import ABC, abstractmethod
+import asyncio
+import logging
+import os
+from threading import Lock, Thread
+from time import perf_counter
+from typing import AsyncGenerator, Awaitable, Callable, Dict, Generator, Iterable, Tuple, TypeVar, Union
+
+import httpx
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_random_exponential
+
+from utils import api_cache
+from utils import serializers
+from utils.metrics import metrics
+from utils.rate_limiter import parse_retry_after
+from utils.rate_limiter import rate_limiter
+
+
+OVERGRAD_API_URL = os.getenv("OVERGRAD_API_URL", "https://api.overgrad.com/api/v1").rstrip("/")
+MAX_WORKERS = int(os.getenv("OVERGRAD_MAX_WORKERS", 1))
+MAX_RATE_LIMIT_RETRIES = 5
+# Connection errors, timeouts and 5xx responses are retried with exponential backoff and full jitter, up to
+# MAX_RETRIES attempts in all
+MAX_RETRIES = int(os.getenv("OVERGRAD_MAX_RETRIES", 6))
+RETRY_MAX_WAIT = float(os.getenv("OVERGRAD_RETRY_MAX_WAIT", 60))
+REQUEST_TIMEOUT = float(os.getenv("OVERGRAD_REQUEST_TIMEOUT", 10))
+# Records per page; an endpoint's "page_size" in OVERGRAD_ENDPOINT_CONFIGS overrides it
+PAGE_SIZE = int(os.getenv("OVERGRAD_PAGE_SIZE", 100))
+# Adaptive page sizes start at MAX_PAGE_SIZE and halve until page 1 comes back within both limits
+MAX_PAGE_SIZE = int(os.getenv("OVERGRAD_MAX_PAGE_SIZE", 1000))
+PAGE_MAX_SECONDS = float(os.getenv("OVERGRAD_PAGE_MAX_SECONDS", 5))
+PAGE_MAX_BYTES = int(os.getenv("OVERGRAD_PAGE_MAX_BYTES", 4 * 1024 * 1024))
+
+T = TypeVar("T")
+
+_loop: Union[None, asyncio.AbstractEventLoop] = None
+_loop_lock = Lock()
+_client: Union[None, httpx.AsyncClient] = None
+
+
+def event_loop() -> asyncio.AbstractEventLoop:
+    """The event loop every client runs on, started on a daemon thread on first use"""
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            Thread(target=_loop.run_forever, name="overgrad-api", daemon=True).start()
+    return _loop
+
+
+def run_blocking(coroutine: Awaitable[T]) -> T:
+    """Runs a coroutine on the clients' event loop and waits for its result; never call it from the loop itself"""
+    return asyncio.run_coroutine_threadsafe(coroutine, event_loop()).result()
+
+
+def iterate_blocking(async_generator: AsyncGenerator[T, None]) -> Generator[T, None, None]:
+    """
+    Drives an async generator on the clients' event loop from sync code. Work the generator started keeps running
+    on the loop between items; closing this generator early closes the async one too.
+    """
+    try:
+        while True:
+            try:
+                yield run_blocking(async_generator.__anext__())
+            except StopAsyncIteration:
+                return
+    finally:
+        run_blocking(async_generator.aclose())
+
+
+def _http_client() -> httpx.AsyncClient:
+    """The shared connection pool; only called on the event loop, so it needs no lock"""
+    global _client
+    if _client is None:
+        try:
+            import h2  # noqa: F401
+            http2 = True
+        except ImportError:
+            http2 = False
+        _client = httpx.AsyncClient(
+            http2=http2,
+            timeout=httpx.Timeout(REQUEST_TIMEOUT),
+            # Concurrency is bounded by each client's workers and the rate limiter, so requests never queue for a
+            # connection and time out waiting
+            limits=httpx.Limits(max_connections=None, max_keepalive_connections=max(10, MAX_WORKERS))
+        )
+    return _client
+
+
+def _is_transient(exception: BaseException) -> bool:
+    if isinstance(exception, (httpx.TimeoutException, httpx.NetworkError, httpx.RemoteProtocolError)):
+        return True
+    if isinstance(exception, httpx.HTTPStatusError):
+        return exception.response.status_code >= 500
+    return False
+
+
+def _is_transient_while_probing(exception: BaseException) -> bool:
+    # A slow page is answered with a smaller one rather than a retry
+    return _is_transient(exception) and not isinstance(exception, httpx.ReadTimeout)
+
+
+def _count_transient_retry(retry_state) -> None:
+    exception = retry_state.outcome.exception()
+    if isinstance(exception, httpx.HTTPStatusError):
+        reason = "server_error"
+    elif isinstance(exception, httpx.TimeoutException):
+        reason = "timeout"
+    else:
+        reason = "connection_error"
+    metrics.increment("api_retries", endpoint=retry_state.args[0]._endpoint, reason=reason)
+
+
+def _cancel(tasks: Iterable[asyncio.Task]) -> None:
+    for task in tasks:
+        if task.done():
+            if not task.cancelled():
+                # Marks a failure nobody is waiting for anymore as seen
+                task.exception()
+        else:
+            task.cancel()
+
+
+class AsyncOvergradAPIBase(ABC):
+    def __init__(self, endpoint):
+        self._endpoint = endpoint
+        self._api_key = os.getenv("OVERGRAD_API_KEY")
+        self._headers = {"ApiKey": self._api_key}
+        self._base_url = self._set_base_url()
+
+    @retry(
+        retry=retry_if_exception(_is_transient),
+        wait=wait_random_exponential(multiplier=1, max=RETRY_MAX_WAIT),
+        stop=stop_after_attempt(MAX_RETRIES),
+        before_sleep=_count_transient_retry,
+        reraise=True
+    )
+    async def _fetch_raw(self, url) -> Tuple[bytes, float]:
+        """The response body and how long the request took, not counting time spent waiting on the rate limiter"""
+        if api_cache.replaying():
+            return api_cache.api_cache().get(url), 0.0
+        for _ in range(MAX_RATE_LIMIT_RETRIES):
+            metrics.observe("rate_limit_wait_seconds", await rate_limiter.acquire_async(), endpoint=self._endpoint)
+            start = perf_counter()
+            response = await _http_client().get(url, headers=self._headers)
+            elapsed = perf_counter() - start
+            metrics.observe("api_request_seconds", elapsed, endpoint=self._endpoint)
+            metrics.observe("api_response_bytes", len(response.content), endpoint=self._endpoint)
+            if response.status_code != 429:
+                break
+            metrics.increment("api_retries", endpoint=self._endpoint, reason="rate_limited")
+            retry_after = parse_retry_after(response.headers.get("Retry-After"))
+            logging.warning(f"Rate limited by Overgrad API; pausing requests for {retry_after:.1f}s")
+            rate_limiter.pause(retry_after)
+        response.raise_for_status()
+        if api_cache.recording():
+            api_cache.api_cache().put(url, response.content)
+        return response.content, elapsed
+
+    async def _call_endpoint(self, url) -> dict:
+        content, _ = await self._fetch_raw(url)
+        return serializers.loads(content)
+
+    @abstractmethod
+    def _generate_url(self, *args, **kwargs):
+        pass
+
+    @abstractmethod
+    def _set_base_url(self):
+        pass
+
+
+class AsyncOvergradAPIPaginator(AsyncOvergradAPIBase):
+    def __init__(
+            self,
+            endpoint,
+            graduation_year: Union[str, None] = None,
+            after_date: Union[str, None] = None,
+            max_workers: int = MAX_WORKERS,
+            page_size: Union[int, str, None] = None
+    ):
+        """`page_size` is a number of records, None for PAGE_SIZE, or "auto" to probe for the largest one that works"""
+        self._record_count = 0
+        self._total_count = None
+        self._total_pages = None
+        self._current_page = 1
+        self._graduation_year = graduation_year
+        self._after_date_str = after_date
+        self._max_workers = max(1, max_workers)
+        self._adaptive = page_size == "auto"
+        self._page_size = PAGE_SIZE if page_size in (None, "auto") else int(page_size)
+        self._probed_page: Union[dict, None] = None
+        # Called with the page number once every record of that page has been consumed
+        self.on_page_complete: Union[None, Callable[[int], None]] = None
+        super().__init__(endpoint)
+
+    def _generate_url(self, page: Union[int, None] = None):
+        page = self._current_page if page is None else page
+        if page == 1:
+            return self._base_url
+        else:
+            return f"{self._base_url}&page={page}"
+
+    def _set_base_url(self):
+        url = [f"{OVERGRAD_API_URL}/{self._endpoint}?"]
+        if self._graduation_year is not None:
+            url.append(f"graduation_year={self._graduation_year}")
+        if self._after_date_str is not None:
+            url.append(f"updated_after={self._after_date_str}")
+        url.append(f"limit={self._page_size}")
+        return "".join(url[:1]) + "&".join(url[1:])
+
+    @property
+    def record_count(self) -> int:
+        return self._record_count
+
+    @property
+    def total_count(self) -> Union[int, None]:
+        return self._total_count
+
+    @property
+    def total_pages(self) -> Union[int, None]:
+        return self._total_pages
+
+    @property
+    def endpoint(self) -> str:
+        return self._endpoint
+
+    @property
+    def page_size(self) -> int:
+        return self._page_size
+
+    @property
+    def graduation_year(self) -> Union[str, None]:
+        return self._graduation_year
+
+    @property
+    def after_date(self) -> Union[str, None]:
+        return self._after_date_str
+
+    def start_after_page(self, page: int, page_size: Union[int, None] = None):
+        """
+        Skips pages that were already processed by an earlier run; page numbers only line up if the page size is
+        the one that run used, so it replaces the configured or probed size
+        """
+        self._current_page = page + 1
+        if page_size is not None:
+            self._adaptive = False
+            self._set_page_size(page_size)
+
+    def _set_page_size(self, page_size: int):
+        self._page_size = page_size
+        self._base_url = self._set_base_url()
+
+    def _label(self) -> str:
+        return f"{self._endpoint} ({self._graduation_year})" if self._graduation_year is not None else self._endpoint
+
+    def _page_size_cache_key(self) -> str:
+        # Stored next to the recorded pages so a replay pages with the size the recording probed
+        return self._base_url.replace(f"limit={self._page_size}", "page_size")
+
+    async def _resolve_page_size(self):
+        """
+        For adaptive page sizes, requests page 1 at MAX_PAGE_SIZE and halves the limit while the API rejects it
+        with a 4xx other than a 429, the request times out, or the response takes longer than PAGE_MAX_SECONDS or
+        is larger than PAGE_MAX_BYTES, down to PAGE_SIZE. The accepted page 1 is kept so it is not fetched twice.
+        """
+        if not self._adaptive:
+            return
+        self._adaptive = False
+        if api_cache.replaying():
+            self._set_page_size(int(api_cache.api_cache().get(self._page_size_cache_key())))
+            return
+        limit = max(MAX_PAGE_SIZE, PAGE_SIZE)
+        while True:
+            self._set_page_size(limit)
+            try:
+                content, elapsed = await self._fetch_raw.retry_with(
+                    retry=retry_if_exception(_is_transient_while_probing)
+                )(self, self._generate_url(1))
+            except httpx.ReadTimeout:
+                if limit <= PAGE_SIZE:
+                    raise
+                logging.info(f"{self._label()} page of {limit} timed out; trying {max(PAGE_SIZE, limit // 2)}")
+                limit = max(PAGE_SIZE, limit // 2)
+                continue
+            except httpx.HTTPStatusError as e:
+                status = e.response.status_code
+                # A 429 that outlasted the rate limit retries says nothing about the limit parameter
+                if limit <= PAGE_SIZE or status == 429 or not 400 <= status < 500:
+                    raise
+                logging.info(
+                    f"{self._label()} rejected limit={limit} with {status}; trying {max(PAGE_SIZE, limit // 2)}"
+                )
+                limit = max(PAGE_SIZE, limit // 2)
+                continue
+            if limit > PAGE_SIZE and (elapsed > PAGE_MAX_SECONDS or len(content) > PAGE_MAX_BYTES):
+                logging.info(
+                    f"{self._label()} page of {limit} took {elapsed:.1f}s for {len(content)} bytes; "
+                    f"trying {max(PAGE_SIZE, limit // 2)}"
+                )
+                limit = max(PAGE_SIZE, limit // 2)
+                continue
+            break
+        self._probed_page = serializers.loads(content)
+        if api_cache.recording():
+            api_cache.api_cache().put(self._page_size_cache_key(), str(limit).encode("utf-8"))
+        logging.info(f"Using pages of {limit} records for {self._label()}")
+
+    def _is_complete(self) -> bool:
+        if self._total_pages is not None:
+            return self._current_page > self._total_pages
+        else:
+            return False
+
+    def _increment_page(self):
+        self._current_page += 1
+
+    def _update_response_counts(self, data: dict):
+        self._total_count = data["total_count"]
+        self._total_pages = data["total_pages"]
+
+    async def _fetch_page(self, page: int) -> dict:
+        if page == 1 and self._probed_page is not None:
+            payload, self._probed_page = self._probed_page, None
+            return payload
+        return await self._call_endpoint(self._generate_url(page))
+
+    async def fetch_page_async(self, page: int) -> dict:
+        """Fetches one page without moving the paginator; the first call also sets total_count and total_pages"""
+        await self._resolve_page_size()
+        payload = await self._fetch_page(page)
+        if self._total_count is None:
+            self._update_response_counts(payload)
+        return payload
+
+    async def _pages(self) -> AsyncGenerator[Tuple[int, dict], None]:
+        """
+        Yields (page number, payload) in page order from the current page on. Page 1 is fetched first to learn
+        total_pages; after that up to max_workers pages are fetched at a time, and up to twice that many are
+        fetched ahead of the consumer.
+        """
+        await self._resolve_page_size()
+        start = perf_counter()
+        first_page = self._current_page
+        semaphore = asyncio.Semaphore(self._max_workers)
+
+        async def fetch(page: int) -> dict:
+            async with semaphore:
+                return await self._fetch_page(page)
+
+        pending: Dict[int, asyncio.Task] = {}
+        next_page = self._current_page
+        try:
+            while not self._is_complete():
+                while next_page == self._current_page or (
+                        self._total_pages is not None
+                        and next_page <= self._total_pages
+                        and len(pending) < self._max_workers * 2
+                ):
+                    pending[next_page] = asyncio.ensure_future(fetch(next_page))
+                    next_page += 1
+                payload = await pending.pop(self._current_page)
+                self._record_count += len(payload["data"])
+                if self._total_count is None:
+                    self._update_response_counts(payload)
+                logging.info(f"Fetched {self._endpoint} page {self._current_page} of {self._total_pages}")
+                yield self._current_page, payload
+                self._increment_page()
+        finally:
+            _cancel(pending.values())
+        elapsed = perf_counter() - start
+        logging.info(
+            f"Fetched {self._record_count} {self._label()} records in {self._current_page - first_page} pages of "
+            f"{self._page_size} in {elapsed:.1f}s; {self._record_count / max(elapsed, 1e-9):.1f} records/s"
+        )
+
+    async def call_endpoint_async(self) -> AsyncGenerator[dict, None]:
+        """Yields the endpoint's records in page order; on_page_complete is called on the event loop"""
+        async for page, payload in self._pages():
+            for record in payload["data"]:
+                yield record
+            if self.on_page_complete is not None:
+                self.on_page_complete(page)
+
+
+class AsyncOvergradAPIFetchRecord(AsyncOvergradAPIBase):
+    def __init__(self, endpoint):
+        super().__init__(endpoint)
+
+    def _generate_url(self, record_id: int):
+        return f"{self._base_url}/{record_id}"
+
+    def _set_base_url(self):
+        return f"{OVERGRAD_API_URL}/{self._endpoint}"
+
+    async def fetch_record_async(self, record_id) -> dict:
+        return await self._call_endpoint(self._generate_url(record_id))
+
+    async def fetch_records_async(
+            self,
+            record_ids: Iterable,
+            max_workers: int = MAX_WORKERS
+    ) -> AsyncGenerator[Tuple, None]:
+        """
+        Fetches up to max_workers records at a time under the shared rate limit; yields (record_id, payload) as
+        they complete
+        """
+        semaphore = asyncio.Semaphore(max(1, max_workers))
+
+        async def fetch(record_id) -> Tuple:
+            async with semaphore:
+                return record_id, await self.fetch_record_async(record_id)
+
+        tasks = [asyncio.ensure_future(fetch(record_id)) for record_id in record_ids]
+        try:
+            for task in asyncio.as_completed(tasks):
+                yield await task
+        finally:
+            _cancel(tasks)
@@ -1,5 +1,7 @@
 from dataclasses import dataclass
-from typing import Union
+from typing import Callable, Union
+
+from utils.serializers import NDJSON_EXTENSIONS
 
 
 @dataclass
@@ -8,6 +10,7 @@ class CustomField:
     gcs_folder: str
     file_name_prefix: str
     fields: set
+    compression: Union[None, str] = None
 
 
 @dataclass
@@ -21,6 +24,43 @@ class Endpoint:
     has_grad_year: bool
     nested_fields: Union[None,list] = None
     custom_field: Union[None, CustomField] = None
+    transform: Union[None, Callable[[dict], dict]] = None
+    compression: Union[None, str] = None
+    page_size: Union[None, int, str] = None
+
+
+def compile_record_transformer(fields: set, nested_fields: Union[None, list] = None) -> Callable[[dict], dict]:
+    """
+    Builds a function that flattens nested fields, fills in missing fields and drops unwanted fields in one pass.
+    Flattened keys are looked up in tables built here instead of being formatted for every record. As before,
+    flattened nested values take precedence over top-level values with the same name.
+    """
+    fields = frozenset(fields)
+    nested_fields = tuple(nested_fields or ())
+    nested_lookup = frozenset(nested_fields)
+    # parent field -> {child key: flattened key}, only for flattened keys that are kept
+    nested_tables = {
+        parent: {field[len(parent) + 1:]: field for field in fields if field.startswith(f"{parent}_")}
+        for parent in nested_fields
+    }
+    empty_record = dict.fromkeys(fields)
+
+    def transform(record: dict) -> dict:
+        cleaned = empty_record.copy()
+        for key, value in record.items():
+            if key in fields and key not in nested_lookup:
+                cleaned[key] = value
+        for parent in nested_fields:
+            children = record.get(parent)
+            if children:
+                table = nested_tables[parent]
+                for child_key, value in children.items():
+                    flattened_key = table.get(child_key)
+                    if flattened_key is not None:
+                        cleaned[flattened_key] = value
+        return cleaned
+
+    return transform
 
 
 def create_endpoint_object(config: dict) -> Endpoint:
@@ -34,12 +74,31 @@ def create_endpoint_object(config: dict) -> Endpoint:
         has_grad_year=config["has_grad_year"]
     )
     endpoint.nested_fields = config.get("nested_fields")
+    endpoint.compression = _validate_compression(config.get("compression"), config["name"])
+    endpoint.page_size = _validate_page_size(config.get("page_size"), config["name"])
     if config.get("custom_field"):
         custom_field = _create_custom_field_object(config["custom_field"])
+        # Custom field files are compressed like their endpoint's unless configured otherwise
+        if custom_field.compression is None:
+            custom_field.compression = endpoint.compression
+        _validate_compression(custom_field.compression, config["name"])
         endpoint.custom_field = custom_field
+    endpoint.transform = compile_record_transformer(endpoint.fields, endpoint.nested_fields)
 
     return endpoint
 
 
+def _validate_compression(compression: Union[None, str], name: str) -> Union[None, str]:
+    if compression not in NDJSON_EXTENSIONS:
+        raise ValueError(f"Unsupported compression for {name}: {compression}")
+    return compression
+
+
+def _validate_page_size(page_size: Union[None, int, str], name: str) -> Union[None, int, str]:
+    if page_size is None or page_size == "auto" or (isinstance(page_size, int) and page_size > 0):
+        return page_size
+    raise ValueError(f"page_size for {name} must be a positive number or \"auto\": {page_size}")
+
+
 def _create_custom_field_object(field: dict) -> CustomField:
     return CustomField(**field)
@@ -1,37 +1,60 @@
 import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import logging
 import os
 import sys
 import traceback
-from typing import List
+from typing import List, Union
 import re
 from datetime import datetime
+from functools import cache
+from time import perf_counter
 
-from gbq_connector import BigQueryClient
 from job_notifications import create_notifications
+from job_notifications import handle_exception
 
 from entities.endpoints import create_endpoint_object
 from entities.endpoints import Endpoint
 from entities.overgrad_api import OvergradAPIPaginator
 from entities.overgrad_api import OvergradAPIFetchRecord
 from utils.config import OVERGRAD_ENDPOINT_CONFIGS
+from utils import api_cache
+from utils import clients
 from utils import helpers
+from utils.metrics import metrics
+from utils.metrics import write_run_summary
+from utils.profiling import PROFILE_COLLAPSED_PATH
+from utils.profiling import PROFILE_STATS_PATH
+from utils.profiling import StackSampler
+from utils.profiling import profile_label
+from utils.university_cache import UniversityCache
+from utils.watermarks import watermark_store
 from workflows.delete_records import run_delete_records_workflow
 from workflows.process_paginated_records import run_record_processing
 
 
-notifications = create_notifications("overgrad-connector", "mailgun", logs="app.log")
+ENDPOINT_WORKERS = int(os.getenv("ENDPOINT_WORKERS", 4))
 
+# Set by _configure so importing this module has no side effects
+args = None
+notifications = None
 
-logging.basicConfig(
-    handlers=[
-        logging.FileHandler(filename="app.log", mode="w+"),
-        logging.StreamHandler(sys.stdout),
-    ],
-    level=logging.INFO,
-    format="%(asctime)s | %(levelname)s: %(message)s",
-    datefmt="%Y-%m-%d %I:%M:%S%p %Z",
-)
+
+def _parse_grad_years(value: str) -> List[str]:
+    """Accepts a single year (2026), a list (2025,2026,2027) or a range (2025-2027)"""
+    years = []
+    for part in value.split(","):
+        part = part.strip()
+        if re.match(r"^\d{4}-\d{4}$", part):
+            start, end = (int(year) for year in part.split("-"))
+            if start > end:
+                raise argparse.ArgumentTypeError(f"Invalid grad year range: {part}")
+            years.extend(str(year) for year in range(start, end + 1))
+        elif re.match(r"^\d{4}$", part):
+            years.append(part)
+        else:
+            raise argparse.ArgumentTypeError(f"Grad years must be in YYYY format: {part}")
+    return list(dict.fromkeys(years))
 
 
 parser = argparse.ArgumentParser(
@@ -39,10 +62,11 @@ parser = argparse.ArgumentParser(
 )
 parser.add_argument(
     "--grad-year",
-    help="Required - Filters for a specific grad year; in YYYY format. If not paired with --updated-since or "
-         "--recent-updates, all records will be fetched.",
+    help="Required - Filters for grad years; a YYYY year, a list (2025,2026) or a range (2025-2027). If not paired "
+         "with --updated-since or --recent-updates, all records will be fetched.",
     required=True,
-    dest="grad_year",
+    type=_parse_grad_years,
+    dest="grad_years",
 )
 parser.add_argument(
     "--delete-records",
@@ -50,6 +74,18 @@ parser.add_argument(
     dest="delete_records",
     action="store_true"
 )
+parser.add_argument(
+    "--dry-run",
+    help="With --delete-records, only logs the records that would be deleted",
+    dest="dry_run",
+    action="store_true"
+)
+parser.add_argument(
+    "--incremental",
+    help="With --delete-records, skips the full API scan when the API IDs still match the last full scan",
+    dest="incremental",
+    action="store_true"
+)
 parser.add_argument(
     "--updated-since",
     help="Date to get updates since; YYYY-MM-DD format; Will not run if the --delete-records arg is also used",
@@ -58,27 +94,110 @@ parser.add_argument(
 )
 parser.add_argument(
     "--recent-updates",
-    help="Gets last updated date from table; Queries api by that date; Will not run if the --delete-records arg "
-         "is also used",
+    help="Queries api for records updated since the endpoint's watermark, falling back to the last updated date "
+         "in the table; Will not run if the --delete-records arg is also used",
     dest="recent_updates",
     action="store_true"
 )
 
-args = parser.parse_args()
+parser.add_argument(
+    "--sharded-output",
+    help="Writes records to size-bounded shard files with a manifest instead of one file per record",
+    dest="sharded_output",
+    action="store_true"
+)
+parser.add_argument(
+    "--output-format",
+    help="ndjson (default) or parquet. parquet writes a full snapshot of each endpoint with a grad year as Parquet "
+         "files per grad year, for backfills; it cannot be combined with --updated-since, --recent-updates, "
+         "--resume or --sharded-output",
+    choices=["ndjson", "parquet"],
+    default="ndjson",
+    dest="output_format",
+)
+parser.add_argument(
+    "--force-upload",
+    help="Writes every record even when its content is unchanged since the last run",
+    dest="force_upload",
+    action="store_true"
+)
+parser.add_argument(
+    "--resume",
+    help="Picks up each endpoint from its last checkpoint instead of starting over from page 1",
+    dest="resume",
+    action="store_true"
+)
+
+parser.add_argument(
+    "--api-cache",
+    help="record stores every Overgrad API response under API_CACHE_DIR; replay answers every request from those "
+         "recordings instead of calling the API, and fails on requests that were never recorded",
+    choices=["record", "replay"],
+    default=None,
+    dest="api_cache",
+)
+
+parser.add_argument(
+    "--profile",
+    help="Samples the stacks of every thread during the run and writes profile.txt and profile.collapsed next to "
+         "app.log",
+    dest="profile",
+    action="store_true"
+)
+
+
+def _configure(argv: Union[None, List[str]] = None) -> None:
+    """Parses the arguments, sets up logging and creates the notifications"""
+    global args, notifications
+    args = parser.parse_args(argv)
+    if args.output_format == "parquet":
+        conflicts = [
+            flag for flag, used in [
+                ("--updated-since", args.updated_since is not None),
+                ("--recent-updates", args.recent_updates),
+                ("--resume", args.resume),
+                ("--sharded-output", args.sharded_output),
+            ] if used
+        ]
+        if conflicts:
+            # Parquet files replace the previous snapshot, so they must hold every record
+            parser.error(f"--output-format parquet cannot be combined with {', '.join(conflicts)}")
+    notifications = create_notifications("overgrad-connector", "mailgun", logs="app.log")
+    logging.basicConfig(
+        handlers=[
+            logging.FileHandler(filename="app.log", mode="w+"),
+            logging.StreamHandler(sys.stdout),
+        ],
+        level=logging.INFO,
+        format="%(asctime)s | %(levelname)s: %(message)s",
+        datefmt="%Y-%m-%d %I:%M:%S%p %Z",
+    )
+
+
+@handle_exception(Exception, return_none=True)
+def _delete_endpoint_records(endpoint: Endpoint, grad_year: str) -> None:
+    """Runs the deletion workflow for one endpoint and grad year; failures are added to the notifications"""
+    api = OvergradAPIPaginator(endpoint.name, grad_year, page_size=endpoint.page_size)
+    with profile_label(endpoint.name):
+        run_delete_records_workflow(api, endpoint, grad_year, dry_run=args.dry_run, incremental=args.incremental)
 
 
 def _delete_records(endpoints: List[Endpoint]) -> None:
-    for endpoint in endpoints:
-        if endpoint.name in ["students", "admissions", "followings"]:
-            api = OvergradAPIPaginator(endpoint.name, args.grad_year)
-            run_delete_records_workflow(api, endpoint, args.grad_year)
+    for grad_year in args.grad_years:
+        for endpoint in endpoints:
+            if endpoint.name in ["students", "admissions", "followings"]:
+                _delete_endpoint_records(endpoint, grad_year)
 
 
+@cache
 def _get_recent_table_updates_dates() -> dict:
+    """
+    Last updated dates per endpoint from the warehouse, read only for endpoints that have no watermark yet, such as
+    on the first run after the watermarks were introduced
+    """
     data_dict = {}
     dataset = os.getenv("GBQ_DATASET")
-    gbq_client = BigQueryClient()
-    df = gbq_client.get_table_as_df("rpt_kipp_forward__overgrad_automation_last_updated_dates", dataset=dataset)
+    df = clients.big_query().get_table_as_df("rpt_kipp_forward__overgrad_automation_last_updated_dates", dataset=dataset)
     data_list = df.to_dict("records")
     for data in data_list:
         data_dict[data["endpoint"]] = data["last_updated_date_string"]
@@ -97,12 +216,29 @@ def _validate_date_format(date_string):
 
 
 def _process_university_records(endpoint: Endpoint, api: OvergradAPIFetchRecord, university_id_queue: set) -> None:
-    for uni_id in university_id_queue:
-        data = api.fetch_record(uni_id)
-        data = data.get("data")
-        cleaned_record = helpers.clean_record_fields(data, endpoint)
-        helpers.load_to_cloud_storage(cleaned_record, endpoint)
-    logging.info(f"Loaded {len(university_id_queue)} records from {endpoint.name}")
+    cache = UniversityCache()
+    stale_ids = cache.get_stale_ids(university_id_queue)
+    logging.info(f"{len(university_id_queue) - len(stale_ids)} university IDs are cached; fetching {len(stale_ids)}")
+    loaded_ids = []
+    stage_metrics = metrics.local(endpoint=endpoint.name)
+    try:
+        for uni_id, data in api.fetch_records(stale_ids):
+            data = data.get("data")
+            start = perf_counter()
+            cleaned_record = endpoint.transform(data)
+            transformed = perf_counter()
+            helpers.load_to_cloud_storage(cleaned_record, endpoint)
+            stage_metrics.observe("transform_seconds", transformed - start)
+            stage_metrics.observe("load_seconds", perf_counter() - transformed)
+            loaded_ids.append(uni_id)
+        # Cached only once their uploads are confirmed, so a failed upload is retried on the next run
+        helpers.flush_cloud_storage(endpoint)
+        cache.add(loaded_ids)
+    finally:
+        stage_metrics.flush()
+        cache.close()
+    written, skipped = helpers.pop_load_counts(endpoint)
+    logging.info(f"Loaded {len(stale_ids)} records from {endpoint.name}; {written} written, {skipped} unchanged")
 
 
 def _setup_endpoints() -> List[Endpoint]:
@@ -122,54 +258,132 @@ def _setup_endpoints() -> List[Endpoint]:
     return endpoints
 
 
-def _record_updates(endpoints: List[Endpoint]):
-    university_id_queue = set()
+def _create_paginator(endpoint: Endpoint, grad_year: Union[None, str]) -> OvergradAPIPaginator:
+    if endpoint.has_grad_year:
+        date_filter = None
+        if endpoint.date_filter:
+            if args.updated_since is not None:
+                try:
+                    date_filter = _validate_date_format(args.updated_since)
+                except ValueError as e:
+                    logging.error(str(e))
+                    sys.exit(1)
+            elif args.recent_updates:
+                date_filter = watermark_store().updated_after(endpoint.name, grad_year)
+                if date_filter is None:
+                    date_filter = _get_recent_table_updates_dates().get(endpoint.name)
+        return OvergradAPIPaginator(endpoint.name, grad_year, date_filter, page_size=endpoint.page_size)
+    else:
+        return OvergradAPIPaginator(endpoint.name, page_size=endpoint.page_size)
+
+
+@handle_exception(Exception, return_none=True)
+def _process_endpoint(endpoint: Endpoint, api: OvergradAPIPaginator, grad_year: Union[None, str]) -> set:
+    """
+    Loads one endpoint for one grad year, or once for endpoints without a grad year, and returns the university
+    IDs it found; failures are added to the notifications
+    """
+    label = f"{endpoint.name} ({grad_year})" if grad_year is not None else endpoint.name
+    logging.info(f"Loading data from {label}")
+    university_ids = set()
+    with profile_label(endpoint.name):
+        # --updated-since may start after the watermark, so only full and --recent-updates runs advance it
+        run_record_processing(
+            endpoint, api, university_ids, grad_year, resume=args.resume,
+            advance_watermark=endpoint.has_grad_year and endpoint.date_filter and args.updated_since is None
+        )
+    return university_ids
 
-    if args.recent_updates:
-        last_updated_dates = _get_recent_table_updates_dates()
 
+@handle_exception(Exception, return_none=True)
+def _process_universities(endpoint: Endpoint, university_id_queue: set) -> None:
+    logging.info(f"Loading data from {endpoint.name}")
+    if university_id_queue:
+        logging.info(f"Loading {len(university_id_queue)} university IDs from queue.")
+        api = OvergradAPIFetchRecord(endpoint.name)
+        with profile_label(endpoint.name):
+            _process_university_records(endpoint, api, university_id_queue)
+    else:
+        logging.info("No university IDs in queue to load.")
+
+
+def _record_updates(endpoints: List[Endpoint]):
+    """
+    Loads the paginated endpoints concurrently under the shared API rate limit. Endpoints with a grad year are
+    loaded once per grad year; the others, and universities, are loaded once per run. Universities are loaded as
+    soon as the endpoints that produce university IDs have finished.
+    """
+    university_endpoint = None
+    paginated_endpoints = []
     for endpoint in endpoints:
-        logging.info(f"Loading data from {endpoint.name}")
         if endpoint.name == "universities":
-            if university_id_queue:
-                logging.info(f"Loading {len(university_id_queue)} university IDs from queue.")
-                api = OvergradAPIFetchRecord(endpoint.name)
-                _process_university_records(endpoint, api, university_id_queue)
-            else:
-                logging.info("No university IDs in queue to load.")
+            university_endpoint = endpoint
+        elif endpoint.has_grad_year:
+            for grad_year in args.grad_years:
+                api = _create_paginator(endpoint, grad_year)
+                paginated_endpoints.append((endpoint, api, grad_year))
         else:
-            if endpoint.has_grad_year:
-                date_filter = None
-                if endpoint.date_filter:
-                    if args.updated_since is not None:
-                        try:
-                            date_filter = _validate_date_format(args.updated_since)
-                        except ValueError as e:
-                            logging.error(str(e))
-                            sys.exit(1)
-                    elif args.recent_updates:
-                        date_filter = last_updated_dates.get(endpoint.name)
-                api = OvergradAPIPaginator(endpoint.name, args.grad_year, date_filter)
-            else:
-                api = OvergradAPIPaginator(endpoint.name)
-            run_record_processing(endpoint, api, university_id_queue, args.grad_year)
+            paginated_endpoints.append((endpoint, _create_paginator(endpoint, None), None))
+
+    university_id_queue = set()
+    with ThreadPoolExecutor(max_workers=ENDPOINT_WORKERS, thread_name_prefix="endpoints") as executor:
+        futures = {
+            executor.submit(_process_endpoint, endpoint, api, grad_year): endpoint
+            for endpoint, api, grad_year in paginated_endpoints
+        }
+        producers = [future for future, endpoint in futures.items() if endpoint.has_university_id]
+        # IDs are only merged here, on the main thread, as each producer finishes
+        for future in as_completed(producers):
+            university_id_queue.update(future.result() or set())
+        if university_endpoint is not None:
+            _process_universities(university_endpoint, university_id_queue)
 
 
 def main():
-    notifications.extend_job_name(f" - {args.grad_year}")
+    notifications.extend_job_name(f" - {', '.join(args.grad_years)}")
     endpoints = _setup_endpoints()
+    if args.sharded_output:
+        helpers.use_sharded_output()
+    if args.output_format == "parquet":
+        helpers.use_parquet_output()
+    api_cache.use_api_cache(args.api_cache)
+    if args.force_upload:
+        helpers.force_upload()
     if args.delete_records:
-        notifications.extend_job_name(" - delete records")
+        notifications.extend_job_name(" - delete records" + (" (dry run)" if args.dry_run else ""))
         _delete_records(endpoints)
     else:
         _record_updates(endpoints)
 
 
+def _attach_run_summary() -> None:
+    """Writes the run metrics and attaches the condensed summary to the notification"""
+    try:
+        notifications.add_log(write_run_summary())
+    except Exception:
+        logging.exception("Failed to write the run summary")
+
+
+def _write_profile(sampler: Union[None, StackSampler]) -> None:
+    if sampler is None:
+        return
+    sampler.stop()
+    sampler.write_stats()
+    sampler.write_collapsed()
+    logging.info(f"Wrote {PROFILE_STATS_PATH} and {PROFILE_COLLAPSED_PATH} from {sampler.samples} samples")
+
+
 if __name__ == "__main__":
+    _configure()
+    sampler = StackSampler().start() if args.profile else None
     try:
         main()
+        _write_profile(sampler)
+        _attach_run_summary()
         notifications.notify()
     except Exception as e:
         logging.exception(e)
         stack_trace = traceback.format_exc()
+        _write_profile(sampler)
+        _attach_run_summary()
         notifications.notify(error_message=stack_trace)
@@ -0,0 +1,101 @@
+"""
+Record and replay of raw Overgrad API responses. In record mode every response body the clients receive is stored
+on disk; in replay mode the clients answer from the store instead of calling the API, without touching the rate
+limiter, so a cohort can be reprocessed after a transform fix in seconds.
+
+Bodies are zlib-compressed and stored once per content hash under API_CACHE_DIR/objects. A SQLite index maps each
+normalized URL (path plus sorted query, without scheme or host) to the hash of its latest body.
+"""
+from hashlib import sha256
+import os
+from threading import Lock, get_ident
+from time import time
+from typing import Union
+from urllib.parse import parse_qsl, urlencode, urlsplit
+import zlib
+
+from utils.config import STATE_DIR
+from utils.state_db import StateDB
+
+
+API_CACHE_DIR = os.getenv("API_CACHE_DIR", os.path.join(STATE_DIR, "api_cache"))
+API_CACHE_COMPRESSION_LEVEL = int(os.getenv("API_CACHE_COMPRESSION_LEVEL", 6))
+
+
+class ApiCacheMiss(Exception):
+    pass
+
+
+def normalize_url(url: str) -> str:
+    """The same request always gets the same key, whatever the host or the order of its query parameters"""
+    parts = urlsplit(url)
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+    return f"{parts.path.rstrip('/')}?{query}" if query else parts.path.rstrip("/")
+
+
+class ApiResponseCache:
+    """Content-addressed store of response bodies keyed by normalized URL. Safe to share between threads."""
+    def __init__(self, directory: str = API_CACHE_DIR):
+        self._objects = os.path.join(directory, "objects")
+        os.makedirs(self._objects, exist_ok=True)
+        self._db = StateDB(
+            os.path.join(directory, "index.db"), "responses", "url TEXT PRIMARY KEY, digest TEXT, recorded_at REAL"
+        )
+
+    def _object_path(self, digest: str) -> str:
+        return os.path.join(self._objects, digest[:2], f"{digest}.z")
+
+    def get(self, url: str) -> bytes:
+        key = normalize_url(url)
+        row = self._db.fetchone("SELECT digest FROM responses WHERE url = ?", (key,))
+        if row is None:
+            raise ApiCacheMiss(f"No recorded response for {key}")
+        try:
+            with open(self._object_path(row[0]), "rb") as f:
+                return zlib.decompress(f.read())
+        except FileNotFoundError:
+            raise ApiCacheMiss(f"The recorded response for {key} is missing from {self._objects}")
+
+    def put(self, url: str, content: bytes) -> None:
+        digest = sha256(content).hexdigest()
+        path = self._object_path(digest)
+        # Identical bodies are stored once; the object is complete before the index points at it
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            temp_path = f"{path}.{os.getpid()}.{get_ident()}.tmp"
+            with open(temp_path, "wb") as f:
+                f.write(zlib.compress(content, API_CACHE_COMPRESSION_LEVEL))
+            os.replace(temp_path, path)
+        self._db.execute(
+            "INSERT OR REPLACE INTO responses (url, digest, recorded_at) VALUES (?, ?, ?)",
+            (normalize_url(url), digest, time())
+        )
+
+
+_mode = None
+_cache = None
+_cache_lock = Lock()
+
+
+def use_api_cache(mode: Union[None, str]) -> None:
+    """"record" stores every response, "replay" answers from the store only, None turns the cache off"""
+    global _mode
+    if mode not in (None, "record", "replay"):
+        raise ValueError(f"Unknown API cache mode: {mode}")
+    _mode = mode
+
+
+def recording() -> bool:
+    return _mode == "record"
+
+
+def replaying() -> bool:
+    return _mode == "replay"
+
+
+def api_cache() -> ApiResponseCache:
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = ApiResponseCache()
+    return _cache
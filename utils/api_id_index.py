@@ -0,0 +1,35 @@
+import os
+from typing import Union
+
+import numpy as np
+
+from utils.config import STATE_DIR
+
+
+API_ID_INDEX_DIR = os.getenv("API_ID_INDEX_DIR", os.path.join(STATE_DIR, "api_ids"))
+
+
+class ApiIdIndex:
+    """
+    The API IDs seen by the last full scan of each (endpoint, grad year), stored as one sorted int64 .npy file
+    per pair. Files are replaced atomically so an interrupted run leaves the previous index in place.
+    """
+    def __init__(self, directory: str = API_ID_INDEX_DIR):
+        os.makedirs(directory, exist_ok=True)
+        self._directory = directory
+
+    def _path(self, endpoint: str, grad_year: str) -> str:
+        return os.path.join(self._directory, f"{endpoint}_{grad_year}.npy")
+
+    def load(self, endpoint: str, grad_year: str) -> Union[np.ndarray, None]:
+        try:
+            return np.load(self._path(endpoint, grad_year))
+        except FileNotFoundError:
+            return None
+
+    def save(self, endpoint: str, grad_year: str, ids: np.ndarray) -> None:
+        path = self._path(endpoint, grad_year)
+        temp_path = f"{path}.tmp"
+        with open(temp_path, "wb") as f:
+            np.save(f, ids)
+        os.replace(temp_path, path)
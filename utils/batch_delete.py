@@ -0,0 +1,89 @@
+from concurrent.futures import ThreadPoolExecutor
+from functools import cache
+import logging
+import os
+from typing import List, NamedTuple, Sequence, Tuple
+
+
+# GCS accepts at most 100 calls in one batch request
+DELETE_BATCH_SIZE = min(100, int(os.getenv("DELETE_BATCH_SIZE", 100)))
+DELETE_WORKERS = int(os.getenv("DELETE_WORKERS", 4))
+
+
+class DeleteError(Exception):
+    pass
+
+
+class DeleteCounts(NamedTuple):
+    deleted: int
+    missing: int
+    missing_blobs: Tuple[str, ...] = ()
+
+
+@cache
+def _batch_class():
+    """
+    google.cloud.storage's Batch, keeping the per-request responses that finish() returns; leaving the batch's
+    context finishes it and would otherwise discard them
+    """
+    from google.cloud.storage.batch import Batch
+
+    class ResponseBatch(Batch):
+        responses: list = []
+
+        def finish(self, raise_exception=True):
+            self.responses = super().finish(raise_exception=raise_exception)
+            return self.responses
+
+    return ResponseBatch
+
+
+def _delete_batch(client, bucket: str, blob_names: Sequence[str]) -> tuple:
+    """Deletes up to DELETE_BATCH_SIZE blobs in one request; returns (deleted, missing blob names, failed blob names)"""
+    gcs_bucket = client.bucket(bucket)
+    try:
+        with _batch_class()(client, raise_exception=False) as batch:
+            for blob_name in blob_names:
+                gcs_bucket.delete_blob(blob_name)
+    except Exception as e:
+        logging.error(f"Batch delete of {len(blob_names)} blob(s) failed: {e}")
+        return 0, [], list(blob_names)
+
+    deleted, missing, failed = 0, [], []
+    for blob_name, response in zip(blob_names, batch.responses):
+        if 200 <= response.status_code < 300:
+            deleted += 1
+        elif response.status_code == 404:
+            missing.append(blob_name)
+        else:
+            logging.error(f"Failed to delete {blob_name}: HTTP {response.status_code}")
+            failed.append(blob_name)
+    return deleted, missing, failed
+
+
+def delete_blobs(
+        client,
+        bucket: str,
+        blob_names: Sequence[str],
+        batch_size: int = DELETE_BATCH_SIZE,
+        max_workers: int = DELETE_WORKERS
+) -> DeleteCounts:
+    """
+    Deletes blobs with a google.cloud.storage.Client in batch requests run on a bounded pool of threads. Blobs
+    that do not exist are counted as missing rather than treated as errors; any other failure raises DeleteError
+    once every batch has finished.
+    """
+    batches = [blob_names[i:i + batch_size] for i in range(0, len(blob_names), batch_size)]
+    deleted = 0
+    missing: List[str] = []
+    failed: List[str] = []
+    with ThreadPoolExecutor(max_workers=max(1, max_workers), thread_name_prefix="delete") as executor:
+        for batch_deleted, batch_missing, batch_failed in executor.map(
+                lambda batch: _delete_batch(client, bucket, batch), batches
+        ):
+            deleted += batch_deleted
+            missing.extend(batch_missing)
+            failed.extend(batch_failed)
+    if failed:
+        raise DeleteError(f"{len(failed)} delete(s) failed, including {failed[0]}")
+    return DeleteCounts(deleted, len(missing), tuple(missing))
@@ -0,0 +1,91 @@
+import json
+import os
+from threading import Lock
+from time import time
+from typing import Iterable, Tuple, Union
+
+from utils.config import STATE_DIR
+from utils.state_db import StateDB
+
+
+CHECKPOINT_PATH = os.getenv("CHECKPOINT_PATH", os.path.join(STATE_DIR, "checkpoints.db"))
+CHECKPOINT_INTERVAL_PAGES = int(os.getenv("CHECKPOINT_INTERVAL_PAGES", 10))
+
+
+class CheckpointStore:
+    """
+    SQLite store of pagination progress per (endpoint, grad year, date filter): the last page whose uploads were
+    confirmed, the page size it was fetched with, the university IDs collected up to that page and when the run
+    that saved it started. Safe to share between threads.
+    """
+    def __init__(self, path: str = CHECKPOINT_PATH):
+        self._db = StateDB(
+            path,
+            "checkpoints",
+            "endpoint TEXT, grad_year TEXT, date_filter TEXT, last_page INTEGER, university_ids TEXT, updated_at REAL, "
+            "page_size INTEGER, run_started_at REAL, PRIMARY KEY (endpoint, grad_year, date_filter)",
+            added_columns={
+                # Checkpoints saved before page sizes were configurable were fetched 100 records at a time
+                "page_size": "INTEGER DEFAULT 100",
+                # Unknown for checkpoints saved before watermarks, so runs resumed from them leave the watermark alone
+                "run_started_at": "REAL",
+            }
+        )
+
+    @staticmethod
+    def _key(endpoint: str, grad_year: Union[None, str], date_filter: Union[None, str]) -> tuple:
+        return endpoint, grad_year or "", date_filter or ""
+
+    def get(
+            self,
+            endpoint: str,
+            grad_year: Union[None, str],
+            date_filter: Union[None, str]
+    ) -> Union[None, Tuple[int, set, int, Union[None, float]]]:
+        """(last page, university IDs, page size, run start as a Unix time or None), or None without a checkpoint"""
+        row = self._db.fetchone(
+            "SELECT last_page, university_ids, page_size, run_started_at FROM checkpoints "
+            "WHERE endpoint = ? AND grad_year = ? AND date_filter = ?",
+            self._key(endpoint, grad_year, date_filter)
+        )
+        if row is None:
+            return None
+        return row[0], set(json.loads(row[1])), row[2], row[3]
+
+    def save(
+            self,
+            endpoint: str,
+            grad_year: Union[None, str],
+            date_filter: Union[None, str],
+            last_page: int,
+            university_ids: Iterable,
+            page_size: int,
+            run_started_at: Union[None, float] = None
+    ):
+        self._db.execute(
+            "INSERT OR REPLACE INTO checkpoints "
+            "(endpoint, grad_year, date_filter, last_page, university_ids, updated_at, page_size, run_started_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                *self._key(endpoint, grad_year, date_filter), last_page, json.dumps(sorted(university_ids)), time(),
+                page_size, run_started_at
+            )
+        )
+
+    def clear(self, endpoint: str, grad_year: Union[None, str], date_filter: Union[None, str]):
+        self._db.execute(
+            "DELETE FROM checkpoints WHERE endpoint = ? AND grad_year = ? AND date_filter = ?",
+            self._key(endpoint, grad_year, date_filter)
+        )
+
+
+_store = None
+_store_lock = Lock()
+
+
+def checkpoint_store() -> CheckpointStore:
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = CheckpointStore()
+    return _store
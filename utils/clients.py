@@ -0,0 +1,68 @@
+"""
+Shared Google clients, created on first use. gbq_connector (and with it google-cloud-bigquery) is only imported
+then too, so importing the connector's modules stays cheap and runs that never query BigQuery never set it up.
+Every caller in the process gets the same instance and its connection pool. Where gbq_connector has no method for
+what the connector needs, the google client is built here with the same credentials and scopes.
+"""
+from threading import Lock
+
+
+_lock = Lock()
+_cloud_storage = None
+_big_query = None
+_bigquery_client = None
+_gcs_client = None
+
+
+def cloud_storage():
+    """The process-wide gbq_connector.CloudStorageClient"""
+    global _cloud_storage
+    with _lock:
+        if _cloud_storage is None:
+            import gbq_connector
+            _cloud_storage = gbq_connector.CloudStorageClient()
+    return _cloud_storage
+
+
+def big_query():
+    """The process-wide gbq_connector.BigQueryClient"""
+    global _big_query
+    with _lock:
+        if _big_query is None:
+            import gbq_connector
+            _big_query = gbq_connector.BigQueryClient()
+    return _big_query
+
+
+def _build_bigquery_client():
+    from google import auth
+    from google.cloud import bigquery
+    credentials, project = auth.default(
+        scopes=["https://www.googleapis.com/auth/drive", "https://www.googleapis.com/auth/bigquery"]
+    )
+    return bigquery.Client(credentials=credentials, project=project)
+
+
+def bigquery_client():
+    """The process-wide google.cloud.bigquery.Client, for streaming query results page by page"""
+    global _bigquery_client
+    with _lock:
+        if _bigquery_client is None:
+            _bigquery_client = _build_bigquery_client()
+    return _bigquery_client
+
+
+def _build_gcs_client():
+    from google import auth
+    from google.cloud import storage
+    credentials, project = auth.default(scopes=["https://www.googleapis.com/auth/cloud-platform"])
+    return storage.Client(credentials=credentials, project=project)
+
+
+def gcs_client():
+    """The process-wide google.cloud.storage.Client, for batch requests and reading blobs"""
+    global _gcs_client
+    with _lock:
+        if _gcs_client is None:
+            _gcs_client = _build_gcs_client()
+    return _gcs_client
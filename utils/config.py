@@ -7,12 +7,22 @@ Here is an explanation of the keys for teh items in the list below:
     has_university_id: Bool - Indicates if teh data contains University IDs
     date_filter: Bool - To indicate if the API endpoint can be filtered by date
     nested_fields: List - A list of nested field in the data. This is used to flatten the data. Not all have this.
+    compression: String - Optional. "gzip" writes the ndjson files gzip-compressed with a .ndjson.gz extension. The
+        external table reading the folder must be defined with compression GZIP.
+    page_size: Int or String - Optional. Records requested per page, OVERGRAD_PAGE_SIZE (100) if not set. "auto" probes
+        for the largest page the API returns within OVERGRAD_PAGE_MAX_SECONDS and OVERGRAD_PAGE_MAX_BYTES.
     custom_field: Dict - Indicates there are nested fields in the data. This data will be parsed out.
         custom_field.field_name: String - Key of the custom field.
         custom_field.gcs_folder: String - The folder where the custom field files will be saved on Google Cloud Storage.
         custom_field.file_name_prefix: String - The prefix for the ndjson files that each custom field record is stored in.
         custom_field.fields: Set - List of fields to filter out any unexpected fields and to verify all of teh fields are present.
+        custom_field.compression: String - Optional. Defaults to the endpoint's compression.
 """
+import os
+
+
+# Directory for state that persists between runs (caches, indexes); mount it as a volume when running in Docker
+STATE_DIR = os.getenv("STATE_DIR", "state")
 
 OVERGRAD_ENDPOINT_CONFIGS = [
     {
@@ -0,0 +1,86 @@
+from hashlib import blake2b
+import json
+import os
+from threading import Lock
+from typing import Iterable, Tuple, Union
+
+from utils.config import STATE_DIR
+from utils.state_db import StateDB
+
+
+HASH_INDEX_PATH = os.getenv("HASH_INDEX_PATH", os.path.join(STATE_DIR, "hash_index.db"))
+UNKNOWN_VARIANT = "?"
+
+
+def record_hash(data: Union[dict, list], variant: Union[None, str] = None) -> bytes:
+    """
+    Hash of the canonical JSON form of a record, so key order does not matter. `variant` names the output format;
+    changing it changes the hash, so records are written again when an endpoint's format changes.
+    """
+    canonical = json.dumps(data, sort_keys=True, separators=(",", ":"), default=str)
+    return blake2b(canonical.encode("utf-8"), digest_size=16, person=(variant or "").encode("utf-8")).digest()
+
+
+class HashIndex:
+    """
+    SQLite index of the content hash and output variant last loaded for each record, keyed by folder (endpoint and
+    grad year) and record ID. New hashes are staged per group and only committed once that group's uploads are
+    confirmed. Safe to share between threads.
+    """
+    def __init__(self, path: str = HASH_INDEX_PATH):
+        self._db = StateDB(
+            path,
+            "hashes",
+            "folder TEXT, record_id TEXT, hash BLOB, variant TEXT, PRIMARY KEY (folder, record_id)",
+            # Records loaded before variants were stored may be in any format
+            added_columns={"variant": f"TEXT DEFAULT '{UNKNOWN_VARIANT}'"}
+        )
+        # Guards the staged hashes
+        self._lock = Lock()
+        self._staged = {}
+
+    def _loaded(self, folder: str, record_id, group: Union[str, None]) -> Union[None, Tuple[bytes, str]]:
+        staged = self._staged.get(group, {}).get((folder, str(record_id)))
+        if staged is not None:
+            return staged
+        return self._db.fetchone(
+            "SELECT hash, variant FROM hashes WHERE folder = ? AND record_id = ?", (folder, str(record_id))
+        )
+
+    def is_unchanged(self, folder: str, record_id, digest: bytes, group: Union[str, None] = None) -> bool:
+        loaded = self._loaded(folder, record_id, group)
+        return loaded is not None and loaded[0] == digest
+
+    def loaded_variant(self, folder: str, record_id, group: Union[str, None] = None) -> Union[None, str]:
+        """The variant the record was last loaded as, UNKNOWN_VARIANT if that was not stored, or None if never"""
+        loaded = self._loaded(folder, record_id, group)
+        return loaded[1] if loaded is not None else None
+
+    def stage(self, folder: str, record_id, digest: bytes, group: Union[str, None] = None, variant: str = ""):
+        with self._lock:
+            self._staged.setdefault(group, {})[(folder, str(record_id))] = (digest, variant)
+
+    def commit(self, groups: Union[Iterable, None] = None):
+        with self._lock:
+            groups = list(self._staged.keys()) if groups is None else groups
+            rows = [
+                (folder, record_id, digest, variant)
+                for group in groups
+                for (folder, record_id), (digest, variant) in self._staged.pop(group, {}).items()
+            ]
+        self._db.executemany(
+            "INSERT OR REPLACE INTO hashes (folder, record_id, hash, variant) VALUES (?, ?, ?, ?)", rows
+        )
+
+    def discard(self, groups: Union[Iterable, None] = None):
+        with self._lock:
+            groups = list(self._staged.keys()) if groups is None else groups
+            for group in groups:
+                self._staged.pop(group, None)
+
+    def forget(self, folder: str, record_ids: Iterable):
+        """Drops records that were deleted so they are loaded again if they ever come back"""
+        self._db.executemany(
+            "DELETE FROM hashes WHERE folder = ? AND record_id = ?",
+            [(folder, str(record_id)) for record_id in record_ids]
+        )
@@ -1,23 +1,173 @@
-from io import BytesIO
-import json
+from collections import Counter
+import logging
 import os
-from typing import Union
-
-from gbq_connector import CloudStorageClient
+from threading import Lock
+from typing import Dict, Iterable, List, Tuple, Union
 
 from entities.endpoints import CustomField
 from entities.endpoints import Endpoint
+from utils import serializers
+from utils.checkpoints import CHECKPOINT_INTERVAL_PAGES
+from utils.config import STATE_DIR
+from utils.hash_index import HashIndex
+from utils.hash_index import record_hash
+from utils.metrics import metrics
+from utils.parquet_sink import ParquetSink
+from utils.shard_writer import ShardedNdjsonSink
+from utils.storage import storage
+from utils.upload_pool import UploadPool
+
+
+def _upload(blob_name: str, content: bytes) -> None:
+    with metrics.timer("upload_seconds"):
+        storage().upload(blob_name, content)
+    metrics.observe("upload_bytes", len(content))
+
+
+upload_pool = UploadPool(_upload)
+shard_sink = ShardedNdjsonSink(storage, upload_pool=upload_pool)
+parquet_sink = ParquetSink(storage, upload_pool=upload_pool)
+_sharded_output = False
+_parquet_output = False
+_skip_unchanged = True
+_hash_index = None
+_hash_index_lock = Lock()
+# Copies of records rewritten in another format, per group: single files, and shard records by (folder, prefix).
+# They are removed once the group's uploads are confirmed.
+_replaced_files: Dict[Union[str, None], List[str]] = {}
+_replaced_shard_records: Dict[Union[str, None], Dict[Tuple[str, str], list]] = {}
+_replaced_lock = Lock()
+load_counts = Counter()
+
+
+def use_sharded_output() -> None:
+    """Buffers records into shard files instead of writing one file per record"""
+    global _sharded_output
+    _sharded_output = True
+
+
+def use_parquet_output() -> None:
+    """
+    Writes records of endpoints with a grad year, and their custom fields, as Parquet files per grad year instead
+    of NDJSON; endpoints without a grad year are still written as NDJSON
+    """
+    global _parquet_output
+    _parquet_output = True
+
+
+def force_upload() -> None:
+    """Writes every record even if its content matches the last run"""
+    global _skip_unchanged
+    _skip_unchanged = False
+
+
+def hash_index() -> HashIndex:
+    global _hash_index
+    with _hash_index_lock:
+        if _hash_index is None:
+            backend = storage().name
+            # Hashes describe what the backend holds, so offline backends never mark records as loaded to GCS
+            if backend == "gcs":
+                _hash_index = HashIndex()
+            elif backend == "memory":
+                _hash_index = HashIndex(":memory:")
+            else:
+                _hash_index = HashIndex(os.path.join(STATE_DIR, f"hash_index_{backend}.db"))
+    return _hash_index
+
+
+def pop_load_counts(endpoint: Union[Endpoint, CustomField], grad_year: Union[None, str] = None) -> Tuple[int, int]:
+    """Returns and resets the number of records written and skipped as unchanged for an endpoint and grad year"""
+    folder = gcs_folder(endpoint, grad_year)
+    return load_counts.pop((folder, "written"), 0), load_counts.pop((folder, "skipped"), 0)
+
+
+def _load_groups(endpoint: Union[None, Endpoint], grad_year: Union[None, str]) -> Union[None, list]:
+    """Uploads are grouped by folder, so each endpoint and grad year is flushed on its own"""
+    if endpoint is None:
+        return None
+    groups = [gcs_folder(endpoint, grad_year)]
+    if endpoint.custom_field is not None:
+        groups.append(gcs_folder(endpoint.custom_field, grad_year))
+    return groups
+
+
+def flush_cloud_storage(endpoint: Union[None, Endpoint] = None, grad_year: Union[None, str] = None) -> None:
+    """
+    Writes out buffered records and waits for background uploads of an endpoint and grad year, or of everything if
+    no endpoint is given; call once an endpoint has finished processing. Raises UploadError if any upload failed.
+    """
+    groups = _load_groups(endpoint, grad_year)
+    try:
+        if _sharded_output:
+            shard_sink.flush(groups)
+        if _parquet_output:
+            parquet_sink.flush(groups)
+        upload_pool.join(groups)
+        storage().flush()
+        _remove_replaced_copies(groups)
+    except Exception:
+        # The records are written again by the next run, which schedules their old copies again
+        _pop_replaced_copies(groups)
+        hash_index().discard(groups)
+        raise
+    hash_index().commit(groups)
+
+
+def _pop_replaced_copies(groups: Union[Iterable, None]) -> Tuple[List[str], Dict[Tuple[str, str], list]]:
+    with _replaced_lock:
+        groups = list(set(_replaced_files) | set(_replaced_shard_records)) if groups is None else groups
+        blob_names = [blob_name for group in groups for blob_name in _replaced_files.pop(group, [])]
+        shard_records = {}
+        for group in groups:
+            for key, record_ids in _replaced_shard_records.pop(group, {}).items():
+                shard_records.setdefault(key, []).extend(record_ids)
+    return blob_names, shard_records
 
 
-cloud_storage = CloudStorageClient()
+def _remove_replaced_copies(groups: Union[Iterable, None]) -> None:
+    blob_names, shard_records = _pop_replaced_copies(groups)
+    if blob_names:
+        counts = storage().delete(blob_names)
+        logging.info(f"Deleted {counts.deleted} file(s) of records since written in another format")
+    for (folder, prefix), record_ids in shard_records.items():
+        not_found = shard_sink.remove(folder, prefix, record_ids)
+        removed = len(record_ids) - len(not_found)
+        if removed:
+            logging.info(f"Removed {removed} record(s) since written as single files from the shards in {folder}")
 
 
-def clean_record_fields(record, endpoint):
-    """Fill out missing expected fields; Filters out unwanted fields"""
-    missing_record_fields = [field for field in endpoint.fields if field not in record.keys()]
-    for field in missing_record_fields:
-        record[field] = None
-    return {k: v for k, v in record.items() if k in endpoint.fields}
+def checkpoints_supported() -> bool:
+    """Parquet output replaces the whole snapshot at the end of a run, so it has nothing to resume from"""
+    return not _parquet_output
+
+
+def checkpoint_due(endpoint: Endpoint, grad_year: Union[None, str], page: int) -> bool:
+    """
+    Whether to flush and checkpoint after `page`. Sharded output is checkpointed once the endpoint has written a
+    full shard, so checkpoints never cut shards short; other output every CHECKPOINT_INTERVAL_PAGES pages.
+    """
+    if _sharded_output:
+        return shard_sink.wrote_shards(_load_groups(endpoint, grad_year))
+    return page % CHECKPOINT_INTERVAL_PAGES == 0
+
+
+def finish_output(endpoint: Endpoint, grad_year: Union[None, str] = None) -> None:
+    """Call once an endpoint and grad year has been loaded in full and flushed; replaces earlier Parquet files"""
+    if _parquet_output and grad_year is not None:
+        parquet_sink.finish(_load_groups(endpoint, grad_year))
+
+
+def parquet_folder(endpoint: Union[Endpoint, CustomField], grad_year: str) -> str:
+    # Hive-style partitions, so a BigQuery table over the folder can be partitioned by grad year
+    return f"overgrad/parquet/{endpoint.gcs_folder}/grad_year={grad_year}"
+
+
+def gcs_folder(endpoint: Union[Endpoint, CustomField], grad_year: Union[None, str] = None) -> str:
+    if grad_year is not None:
+        return f"overgrad/{endpoint.gcs_folder}/{grad_year}"
+    else:
+        return f"overgrad/{endpoint.gcs_folder}"
 
 
 def load_to_cloud_storage(
@@ -34,15 +184,67 @@ def load_to_cloud_storage(
     if isinstance(data, dict):
         data = [data]
 
-    # Create ndjson file object in memory
-    ndjson_lines = [json.dumps(record) for record in data]
-    ndjson_content = "\n".join(ndjson_lines).encode('utf-8')
-    file_obj = BytesIO(ndjson_content)
+    folder = gcs_folder(endpoint, grad_year)
+    if _parquet_output and grad_year is not None:
+        # Every Parquet file set is a full snapshot, so unchanged records are written too
+        parquet_sink.add(parquet_folder(endpoint, grad_year), endpoint.file_name_prefix, endpoint.fields, data, folder)
+        load_counts[(folder, "written")] += 1
+        return
 
-    # Load to Google Cloud Storage
-    if grad_year is not None:
-        blob_name = f"overgrad/{endpoint.gcs_folder}/{grad_year}/{endpoint.file_name_prefix}_{record_id}.ndjson"
-    else:
-        blob_name = f"overgrad/{endpoint.gcs_folder}/{endpoint.file_name_prefix}_{record_id}.ndjson"
-    bucket = os.getenv("BUCKET")
-    cloud_storage.load_in_memory_file_to_cloud(bucket, blob_name, file_obj)
\ No newline at end of file
+    variant = _output_variant(endpoint.compression)
+    digest = record_hash(data, variant)
+    group = folder
+    if _skip_unchanged and hash_index().is_unchanged(folder, record_id, digest, group):
+        load_counts[(folder, "skipped")] += 1
+        return
+    previous_variant = hash_index().loaded_variant(folder, record_id, group)
+    hash_index().stage(folder, record_id, digest, group, variant)
+    load_counts[(folder, "written")] += 1
+    # Only switching formats can leave another copy of the record behind
+    replaces = previous_variant not in (None, variant)
+
+    lines = [serializers.dumps_line(record) for record in data]
+    if _sharded_output:
+        shard_sink.add(folder, endpoint.file_name_prefix, record_id, lines, group, endpoint.compression)
+        # The shard sink replaces records already in its shards itself
+        if replaces and not previous_variant.startswith("shard:"):
+            _replace_later(group, blob_names=[
+                f"{folder}/{endpoint.file_name_prefix}_{record_id}{extension}"
+                for extension in serializers.NDJSON_EXTENSIONS.values()
+            ])
+        return
+
+    # Create ndjson content in memory
+    ndjson_content = serializers.encode_ndjson(lines, endpoint.compression)
+
+    # Queue the upload to Google Cloud Storage; flush_cloud_storage waits for it
+    extension = serializers.NDJSON_EXTENSIONS[endpoint.compression]
+    blob_name = f"{folder}/{endpoint.file_name_prefix}_{record_id}{extension}"
+    upload_pool.submit(blob_name, ndjson_content, group)
+    if replaces:
+        _replace_later(
+            group,
+            blob_names=[
+                f"{folder}/{endpoint.file_name_prefix}_{record_id}{other}"
+                for other in serializers.NDJSON_EXTENSIONS.values() if other != extension
+            ],
+            shard_record=None if previous_variant.startswith("file:") else (folder, endpoint.file_name_prefix, record_id)
+        )
+
+
+def _output_variant(compression: Union[None, str]) -> str:
+    """How records are written, which is part of their hash: as shards or single files, and the compression"""
+    return f"{'shard' if _sharded_output else 'file'}:{compression or ''}"
+
+
+def _replace_later(
+        group: Union[str, None],
+        blob_names: Iterable[str] = (),
+        shard_record: Union[None, Tuple[str, str, str]] = None
+) -> None:
+    """Schedules copies of a record in another format to be removed once the group's uploads are confirmed"""
+    with _replaced_lock:
+        _replaced_files.setdefault(group, []).extend(blob_names)
+        if shard_record is not None:
+            folder, prefix, record_id = shard_record
+            _replaced_shard_records.setdefault(group, {}).setdefault((folder, prefix), []).append(record_id)
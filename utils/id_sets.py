@@ -0,0 +1,29 @@
+"""
+Compact sets of record IDs held as sorted, unique int64 NumPy arrays: 8 bytes per ID instead of a Python str in
+a set. Used by the delete-records workflow to diff warehouse IDs against API IDs.
+"""
+from array import array
+from typing import Iterable
+
+import numpy as np
+
+
+def to_id_array(ids: Iterable) -> np.ndarray:
+    """Builds a sorted, unique int64 array from an iterable of IDs without materializing Python objects for all of them"""
+    buffer = array("q")
+    for record_id in ids:
+        if record_id is not None:
+            buffer.append(int(record_id))
+    return np.unique(np.frombuffer(buffer, dtype=np.int64))
+
+
+def concat_id_arrays(chunks: Iterable[np.ndarray]) -> np.ndarray:
+    chunks = list(chunks)
+    if not chunks:
+        return np.empty(0, dtype=np.int64)
+    return np.unique(np.concatenate(chunks))
+
+
+def missing_ids(expected: np.ndarray, found: np.ndarray) -> np.ndarray:
+    """IDs in `expected` that are not in `found`; both must be sorted and unique"""
+    return np.setdiff1d(expected, found, assume_unique=True)
@@ -0,0 +1,231 @@
+"""
+Process-wide run metrics: histograms and counters keyed by name and labels. Histograms whose name ends in
+_seconds use time buckets and those ending in _bytes use size buckets. At the end of a run the metrics are
+written as a JSON summary, optionally as a Prometheus textfile, and as a condensed text summary for the
+notification email.
+"""
+from bisect import bisect_left
+from contextlib import contextmanager
+import json
+import os
+from threading import Lock
+from time import perf_counter, time
+from typing import Dict, Iterator, List, Tuple, Union
+
+
+METRICS_SUMMARY_PATH = os.getenv("METRICS_SUMMARY_PATH", "run_summary.json")
+METRICS_PROMETHEUS_PATH = os.getenv("METRICS_PROMETHEUS_PATH")
+
+SECONDS_BUCKETS = (0.0001, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+BYTES_BUCKETS = tuple(2 ** power for power in range(8, 27, 2))
+DEFAULT_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def _buckets_for(name: str) -> tuple:
+    if name.endswith("_seconds"):
+        return SECONDS_BUCKETS
+    if name.endswith("_bytes"):
+        return BYTES_BUCKETS
+    return DEFAULT_BUCKETS
+
+
+class Histogram:
+    def __init__(self, buckets: tuple):
+        self.buckets = buckets
+        # The last count is for values above every bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def merge(self, other: "Histogram") -> None:
+        self.counts = [count + other_count for count, other_count in zip(self.counts, other.counts)]
+        self.count += other.count
+        self.sum += other.sum
+        self.max = max(self.max, other.max)
+
+    def quantile(self, q: float) -> float:
+        """Upper bound of the bucket holding the q-th value; the max for values above the last bucket"""
+        target = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= target:
+                return min(bound, self.max)
+        return self.max
+
+    def to_dict(self) -> dict:
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "mean": self.sum / self.count if self.count else 0.0,
+            "p50": self.quantile(0.5),
+            "p95": self.quantile(0.95),
+            "max": self.max,
+            "buckets": dict(zip([str(bound) for bound in self.buckets] + ["+Inf"], self.counts)),
+        }
+
+
+class LocalHistograms:
+    """
+    Histograms observed by a single thread without taking the registry's lock, for per-record timings; `flush`
+    merges them into the registry
+    """
+    def __init__(self, registry: "MetricsRegistry", labels: dict):
+        self._registry = registry
+        self._labels = labels
+        self._histograms: Dict[str, Histogram] = {}
+
+    def observe(self, name: str, value: float) -> None:
+        histogram = self._histograms.get(name)
+        if histogram is None:
+            histogram = self._histograms[name] = Histogram(_buckets_for(name))
+        histogram.observe(value)
+
+    def flush(self) -> None:
+        histograms, self._histograms = self._histograms, {}
+        for name, histogram in histograms.items():
+            self._registry.merge(name, histogram, **self._labels)
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._lock = Lock()
+        self._histograms: Dict[Tuple[str, Labels], Histogram] = {}
+        self._counters: Dict[Tuple[str, Labels], float] = {}
+        self._started_at = time()
+
+    @staticmethod
+    def _key(name: str, labels: dict) -> Tuple[str, Labels]:
+        return name, tuple(sorted((key, str(value)) for key, value in labels.items() if value is not None))
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        key = self._key(name, labels)
+        with self._lock:
+            if key not in self._histograms:
+                self._histograms[key] = Histogram(_buckets_for(name))
+            self._histograms[key].observe(value)
+
+    def increment(self, name: str, value: float = 1, **labels) -> None:
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def merge(self, name: str, histogram: Histogram, **labels) -> None:
+        key = self._key(name, labels)
+        with self._lock:
+            if key not in self._histograms:
+                self._histograms[key] = Histogram(histogram.buckets)
+            self._histograms[key].merge(histogram)
+
+    def local(self, **labels) -> "LocalHistograms":
+        return LocalHistograms(self, labels)
+
+    @contextmanager
+    def timer(self, name: str, **labels) -> Iterator[None]:
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, perf_counter() - start, **labels)
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            return {
+                "started_at": self._started_at,
+                "duration_seconds": time() - self._started_at,
+                "histograms": [
+                    {"name": name, "labels": dict(labels), **histogram.to_dict()}
+                    for (name, labels), histogram in sorted(self._histograms.items())
+                ],
+                "counters": [
+                    {"name": name, "labels": dict(labels), "value": value}
+                    for (name, labels), value in sorted(self._counters.items())
+                ],
+            }
+
+    def write_json(self, path: str = METRICS_SUMMARY_PATH) -> None:
+        with open(path, "w") as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+    def write_prometheus(self, path: str) -> None:
+        """Writes the Prometheus text format; the file is replaced atomically for the node exporter's textfile collector"""
+        lines = []
+        summary = self.to_dict()
+        for histogram in summary["histograms"]:
+            name = f"overgrad_{histogram['name']}"
+            cumulative = 0
+            for bound, count in histogram["buckets"].items():
+                cumulative += count
+                lines.append(f"{name}_bucket{_format_labels(histogram['labels'], le=bound)} {cumulative}")
+            lines.append(f"{name}_sum{_format_labels(histogram['labels'])} {histogram['sum']}")
+            lines.append(f"{name}_count{_format_labels(histogram['labels'])} {histogram['count']}")
+        for counter in summary["counters"]:
+            lines.append(f"overgrad_{counter['name']}_total{_format_labels(counter['labels'])} {counter['value']}")
+        lines.append(f"overgrad_run_duration_seconds {summary['duration_seconds']}")
+        temp_path = f"{path}.tmp"
+        with open(temp_path, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(temp_path, path)
+
+    def summary_lines(self) -> List[str]:
+        """One line per metric with the labels summed together"""
+        merged: Dict[str, Histogram] = {}
+        counters: Dict[str, float] = {}
+        with self._lock:
+            for (name, _), histogram in self._histograms.items():
+                total = merged.setdefault(name, Histogram(histogram.buckets))
+                total.counts = [a + b for a, b in zip(total.counts, histogram.counts)]
+                total.count += histogram.count
+                total.sum += histogram.sum
+                total.max = max(total.max, histogram.max)
+            for (name, _), value in self._counters.items():
+                counters[name] = counters.get(name, 0) + value
+            duration = time() - self._started_at
+        lines = [f"run duration: {duration:.1f}s"]
+        for name, histogram in sorted(merged.items()):
+            fmt = _format_seconds if name.endswith("_seconds") else _format_number
+            lines.append(
+                f"{name}: count {histogram.count}, total {fmt(histogram.sum)}, "
+                f"mean {fmt(histogram.sum / histogram.count)}, p95 <= {fmt(histogram.quantile(0.95))}, "
+                f"max {fmt(histogram.max)}"
+            )
+        lines.extend(f"{name}: {value:g}" for name, value in sorted(counters.items()))
+        return lines
+
+
+def _format_seconds(value: float) -> str:
+    return f"{value:.3f}s" if value >= 0.1 else f"{value * 1000:.2f}ms"
+
+
+def _format_number(value: float) -> str:
+    return f"{value:,.0f}"
+
+
+def _format_labels(labels: dict, **extra) -> str:
+    labels = {**labels, **extra}
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels.items()) + "}"
+
+
+metrics = MetricsRegistry()
+
+
+def write_run_summary(summary_path: str = METRICS_SUMMARY_PATH, prometheus_path: Union[None, str] = METRICS_PROMETHEUS_PATH) -> str:
+    """Writes the JSON summary, the Prometheus textfile when configured, and the condensed text summary; returns the latter's path"""
+    metrics.write_json(summary_path)
+    if prometheus_path:
+        metrics.write_prometheus(prometheus_path)
+    text_path = f"{os.path.splitext(summary_path)[0]}.txt"
+    with open(text_path, "w") as f:
+        f.write("\n".join(metrics.summary_lines()) + "\n")
+    return text_path
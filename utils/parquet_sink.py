@@ -0,0 +1,147 @@
+from datetime import datetime, timezone
+from io import BytesIO
+import json
+import logging
+import os
+from threading import RLock
+from typing import TYPE_CHECKING, Callable, Dict, Iterable, List, Set, Tuple, Union
+from uuid import uuid4
+
+from utils.storage import StorageBackend
+from utils.upload_pool import UploadPool
+
+# pyarrow takes a fifth of a second to import, so it is only imported once Parquet output is written
+if TYPE_CHECKING:
+    import pyarrow as pa
+
+
+PARQUET_MAX_RECORDS = int(os.getenv("PARQUET_MAX_RECORDS", 100000))
+PARQUET_COMPRESSION = os.getenv("PARQUET_COMPRESSION", "snappy")
+
+
+def _as_strings(values: list) -> "pa.Array":
+    """Strings are kept as they are; numbers, booleans, objects and lists are written as JSON"""
+    import pyarrow as pa
+    return pa.array(
+        [None if value is None else value if isinstance(value, str) else json.dumps(value) for value in values],
+        type=pa.string()
+    )
+
+
+class _ColumnBuffer:
+    def __init__(self, columns: List[str]):
+        self.columns: Dict[str, list] = {column: [] for column in columns}
+        self.rows = 0
+
+    def add(self, records: List[dict]):
+        for column, values in self.columns.items():
+            values.extend(record.get(column) for record in records)
+        self.rows += len(records)
+
+
+class ParquetSink:
+    """
+    Buffers cleaned records per folder (endpoint and grad year) as columns and writes them as Parquet files of up
+    to `max_records` rows. The columns are the endpoint's `fields`, all of them strings, so every file of every run
+    and grad year has the same schema whatever values the API returns; numbers, booleans, objects and lists are
+    stored as JSON.
+
+    Files are written to a staging folder that the external tables do not read. `finish` moves them into place
+    and removes the files of earlier runs once the folder has been loaded in full, so a failed run never leaves
+    part of a snapshot next to the previous one.
+    """
+    def __init__(
+            self,
+            get_storage: Callable[[], StorageBackend],
+            max_records: int = PARQUET_MAX_RECORDS,
+            compression: str = PARQUET_COMPRESSION,
+            upload_pool: Union[UploadPool, None] = None
+    ):
+        self._get_storage = get_storage
+        self._upload_pool = upload_pool
+        self._max_records = max_records
+        self._compression = compression
+        self._run_id = f"{datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%S')}_{uuid4().hex[:6]}"
+        self._file_sequence = 0
+        self._buffers: Dict[Tuple[str, str], _ColumnBuffer] = {}
+        self._groups: Dict[Tuple[str, str], Union[str, None]] = {}
+        self._staged: Dict[Tuple[str, str], List[str]] = {}
+        self._lock = RLock()
+
+    @staticmethod
+    def _staging_folder(folder: str) -> str:
+        return folder.replace("overgrad/", "overgrad/_staging/", 1)
+
+    def add(
+            self,
+            folder: str,
+            prefix: str,
+            fields: Iterable[str],
+            records: List[dict],
+            group: Union[str, None] = None
+    ):
+        key = (folder, prefix)
+        with self._lock:
+            self._groups[key] = group
+            buffer = self._buffers.get(key)
+            if buffer is None:
+                buffer = self._buffers[key] = _ColumnBuffer(sorted(set(fields)))
+            buffer.add(records)
+            full = buffer.rows >= self._max_records
+        if full:
+            self._write_file(key)
+
+    @staticmethod
+    def _table(buffer: _ColumnBuffer) -> "pa.Table":
+        import pyarrow as pa
+        return pa.table({column: _as_strings(values) for column, values in buffer.columns.items()})
+
+    def _write_file(self, key: Tuple[str, str]):
+        import pyarrow.parquet as pq
+        with self._lock:
+            buffer = self._buffers.pop(key, None)
+            if not buffer:
+                return
+            self._file_sequence += 1
+            sequence = self._file_sequence
+        table = self._table(buffer)
+        folder, prefix = key
+        blob_name = f"{self._staging_folder(folder)}/{prefix}{self._run_id}_{sequence:05d}.parquet"
+        content = BytesIO()
+        pq.write_table(table, content, compression=self._compression)
+        with self._lock:
+            self._staged.setdefault(key, []).append(blob_name)
+        if self._upload_pool is not None:
+            self._upload_pool.submit(blob_name, content.getvalue(), self._groups.get(key))
+        else:
+            self._get_storage().upload(blob_name, content.getvalue())
+        logging.debug(f"Wrote {table.num_rows} records to {blob_name}")
+
+    def _keys(self, groups: Union[Iterable, None]) -> Set[Tuple[str, str]]:
+        with self._lock:
+            return {key for key in self._groups if groups is None or self._groups[key] in groups}
+
+    def flush(self, groups: Union[Iterable, None] = None):
+        """Writes out the buffered records of the folders in `groups`, or of all folders if no groups are given"""
+        for key in self._keys(groups):
+            self._write_file(key)
+
+    def finish(self, groups: Union[Iterable, None] = None):
+        """
+        Moves this run's files for the folders in `groups` into place and removes the files of earlier runs, along
+        with files staged by runs that failed; call once the folders have been flushed and their uploads confirmed
+        """
+        storage = self._get_storage()
+        for folder, prefix in self._keys(groups):
+            with self._lock:
+                staged = self._staged.pop((folder, prefix), [])
+            previous = storage.list(f"{folder}/{prefix}", ".parquet")
+            for blob_name in staged:
+                storage.move(blob_name, f"{folder}/{blob_name.rsplit('/', 1)[1]}")
+            storage.delete(previous)
+            abandoned = storage.list(f"{self._staging_folder(folder)}/{prefix}", ".parquet")
+            storage.delete(abandoned)
+            logging.info(
+                f"Replaced {len(previous)} Parquet file(s) in {folder} with {len(staged)}"
+                + (f"; removed {len(abandoned)} left by failed runs" if abandoned else "")
+            )
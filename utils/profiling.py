@@ -0,0 +1,139 @@
+"""
+Opt-in sampling profiler for whole runs. A daemon thread samples the stack of every thread at a fixed interval,
+so the endpoint threads, page fetchers and upload workers are all covered. Samples are wall-clock: time spent
+waiting on the network or a lock shows up too. Each sample is keyed by the endpoint the thread is working on,
+or by the thread's name for pool threads.
+
+Nothing here runs unless a StackSampler is started; profile_label is a no-op otherwise.
+"""
+from collections import Counter
+from concurrent.futures import thread as futures_thread
+from contextlib import contextmanager
+import os
+import re
+import site
+import sys
+import sysconfig
+import threading
+from typing import Dict, Iterator, Tuple
+
+
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", 0.005))
+PROFILE_COLLAPSED_PATH = "profile.collapsed"
+PROFILE_STATS_PATH = "profile.txt"
+
+_PATH_PREFIXES = [
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))) + os.sep,
+    sysconfig.get_paths()["stdlib"] + os.sep,
+    *(path + os.sep for path in site.getsitepackages()),
+]
+_POOL_WORKER_FILE = futures_thread.__file__
+
+_active = None
+_labels: Dict[int, str] = {}
+
+
+@contextmanager
+def profile_label(label: str) -> Iterator[None]:
+    """Attributes the current thread's samples to `label`, e.g. an Endpoint.name, while the block runs"""
+    if _active is None:
+        yield
+        return
+    thread_id = threading.get_ident()
+    previous = _labels.get(thread_id)
+    _labels[thread_id] = label
+    try:
+        yield
+    finally:
+        if previous is None:
+            _labels.pop(thread_id, None)
+        else:
+            _labels[thread_id] = previous
+
+
+def _thread_label(name: str) -> str:
+    # Pool threads are named prefix_N; group them by prefix
+    return re.sub(r"_\d+$", "", name)
+
+
+class StackSampler:
+    def __init__(self, interval: float = PROFILE_INTERVAL):
+        self._interval = interval
+        self._stacks: Counter = Counter()
+        self._frame_names: Dict[object, str] = {}
+        self._stop = threading.Event()
+        self._thread = None
+        self.samples = 0
+
+    def start(self) -> "StackSampler":
+        global _active
+        _active = self
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        global _active
+        self._stop.set()
+        self._thread.join()
+        _active = None
+        _labels.clear()
+
+    def _frame_name(self, code) -> str:
+        name = self._frame_names.get(code)
+        if name is None:
+            filename = code.co_filename
+            prefix = max((p for p in _PATH_PREFIXES if filename.startswith(p)), key=len, default="")
+            name = f"{code.co_name} ({filename[len(prefix):]}:{code.co_firstlineno})".replace(";", ",")
+            self._frame_names[code] = name
+        return name
+
+    def _run(self) -> None:
+        own_id = threading.get_ident()
+        while not self._stop.wait(self._interval):
+            thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                # Pool threads waiting for work are skipped; any other waiting is part of the profile
+                code = frame.f_code
+                if thread_id == own_id or (code.co_name == "_worker" and code.co_filename == _POOL_WORKER_FILE):
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(self._frame_name(frame.f_code))
+                    frame = frame.f_back
+                label = _labels.get(thread_id) or _thread_label(thread_names.get(thread_id, "thread"))
+                self._stacks[(label, tuple(reversed(stack)))] += 1
+            self.samples += 1
+
+    def write_collapsed(self, path: str = PROFILE_COLLAPSED_PATH) -> None:
+        """One `label;outer;...;inner count` line per stack, for flamegraph.pl or speedscope"""
+        with open(path, "w") as f:
+            for (label, stack), count in self._stacks.most_common():
+                f.write(f"{';'.join((label,) + stack)} {count}\n")
+
+    def write_stats(self, path: str = PROFILE_STATS_PATH, top: int = 25) -> None:
+        """Top functions by self and total samples, overall and per label"""
+        by_label: Dict[str, Tuple[Counter, Counter, int]] = {}
+        for (label, stack), count in self._stacks.items():
+            for key in ("all", label):
+                own, total, samples = by_label.get(key, (Counter(), Counter(), 0))
+                own[stack[-1]] += count
+                for name in set(stack):
+                    total[name] += count
+                by_label[key] = (own, total, samples + count)
+
+        lines = [
+            f"{self.samples} samples every {self._interval * 1000:g}ms; counts are thread-samples of wall-clock time",
+            "",
+        ]
+        ordered = ["all"] + sorted((label for label in by_label if label != "all"), key=lambda k: -by_label[k][2])
+        for label in ordered:
+            own, total, samples = by_label[label]
+            lines.append(f"== {label}: {samples} thread-samples")
+            lines.append("-- self")
+            lines.extend(f"{count:8d} {count / samples:6.1%}  {name}" for name, count in own.most_common(top))
+            lines.append("-- total")
+            lines.extend(f"{count:8d} {count / samples:6.1%}  {name}" for name, count in total.most_common(top))
+            lines.append("")
+        with open(path, "w") as f:
+            f.write("\n".join(lines))
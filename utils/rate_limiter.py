@@ -0,0 +1,89 @@
+import asyncio
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+import os
+from threading import Lock
+from time import monotonic, sleep
+from typing import Union
+
+
+DEFAULT_RETRY_AFTER = 60
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket. Tokens refill continuously at `rate` per second up to `burst`, so time spent
+    waiting on the network counts toward the budget instead of being paid on top of it.
+    """
+    def __init__(self, rate: float, burst: int = 1):
+        self._rate = rate
+        self._capacity = max(1, burst)
+        self._tokens = float(self._capacity)
+        self._updated_at = monotonic()
+        self._paused_until = 0.0
+        self._lock = Lock()
+
+    def _refill(self, now: float):
+        self._tokens = min(self._capacity, self._tokens + (now - self._updated_at) * self._rate)
+        self._updated_at = now
+
+    def try_acquire(self) -> float:
+        """Takes a token if one is available and returns 0; otherwise returns the seconds to wait before retrying"""
+        with self._lock:
+            now = monotonic()
+            if now < self._paused_until:
+                return self._paused_until - now
+            self._refill(now)
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0.0
+            return (1 - self._tokens) / self._rate
+
+    def acquire(self) -> float:
+        """Blocks until a token is available; returns the number of seconds spent waiting"""
+        waited = 0.0
+        while True:
+            wait = self.try_acquire()
+            if wait == 0:
+                return waited
+            sleep(wait)
+            waited += wait
+
+    async def acquire_async(self) -> float:
+        """Same as acquire, but waits with asyncio.sleep so the event loop keeps running"""
+        waited = 0.0
+        while True:
+            wait = self.try_acquire()
+            if wait == 0:
+                return waited
+            await asyncio.sleep(wait)
+            waited += wait
+
+    def pause(self, seconds: float):
+        """Stops handing out tokens for `seconds`; used when the API responds with a 429"""
+        with self._lock:
+            now = monotonic()
+            self._paused_until = max(self._paused_until, now + seconds)
+            self._tokens = 0.0
+            self._updated_at = max(now, self._paused_until)
+
+
+def parse_retry_after(value: Union[str, None]) -> float:
+    """Retry-After may be a number of seconds or an HTTP date"""
+    if not value:
+        return DEFAULT_RETRY_AFTER
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return DEFAULT_RETRY_AFTER
+    return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+
+rate_limiter = TokenBucket(
+    rate=float(os.getenv("OVERGRAD_REQUESTS_PER_SECOND", 0.9)),
+    burst=int(os.getenv("OVERGRAD_BURST", 1))
+)
@@ -0,0 +1,56 @@
+"""
+JSON encoding and decoding used across the connector.
+
+Decoding uses orjson when it is installed, reading response bodies straight from bytes; set JSON_BACKEND=stdlib to
+force the standard library. Encoding of NDJSON lines always uses the standard library's C encoder: orjson writes
+compact separators and raw UTF-8, which would change the bytes of every file the BigQuery external tables read.
+
+NDJSON files can be gzip-compressed per endpoint. Compressed files are named .ndjson.gz and uploaded without a
+Content-Encoding header, so cloud storage serves the gzip bytes as they are and the external table reads them
+with its compression set to GZIP.
+"""
+import gzip
+from io import BytesIO
+import json
+import os
+from typing import Iterable, Union
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+JSON_BACKEND = os.getenv("JSON_BACKEND", "orjson" if orjson is not None else "stdlib")
+GZIP_LEVEL = int(os.getenv("GZIP_LEVEL", 6))
+
+NDJSON_EXTENSIONS = {None: ".ndjson", "gzip": ".ndjson.gz"}
+
+
+def loads(content: Union[bytes, str]):
+    if JSON_BACKEND == "orjson" and orjson is not None:
+        return orjson.loads(content)
+    return json.loads(content)
+
+
+def dumps_line(record: Union[dict, list]) -> bytes:
+    """Encodes a record as one NDJSON line, byte-for-byte identical to json.dumps(record).encode('utf-8')"""
+    return json.dumps(record).encode("utf-8")
+
+
+def encode_ndjson(lines: Iterable[bytes], compression: Union[None, str] = None) -> bytes:
+    """Joins NDJSON lines into file content; gzip content is compressed line by line rather than from a joined copy"""
+    if compression is None:
+        return b"\n".join(lines)
+    buffer = BytesIO()
+    # mtime=0 keeps the output identical for identical records
+    with gzip.GzipFile(fileobj=buffer, mode="wb", compresslevel=GZIP_LEVEL, mtime=0) as f:
+        for i, line in enumerate(lines):
+            if i:
+                f.write(b"\n")
+            f.write(line)
+    return buffer.getvalue()
+
+
+def decode_ndjson(content: bytes, compression: Union[None, str] = None) -> bytes:
+    return gzip.decompress(content) if compression == "gzip" else content
@@ -0,0 +1,208 @@
+from datetime import datetime, timezone
+import json
+import logging
+import os
+from threading import RLock
+from typing import Callable, Dict, Iterable, List, Tuple, Union
+from uuid import uuid4
+
+from utils import serializers
+from utils.storage import StorageBackend
+from utils.upload_pool import UploadPool
+
+
+SHARD_MAX_RECORDS = int(os.getenv("SHARD_MAX_RECORDS", 5000))
+SHARD_MAX_BYTES = int(os.getenv("SHARD_MAX_BYTES", 32 * 1024 * 1024))
+
+
+class _ShardBuffer:
+    def __init__(self):
+        self.lines: List[bytes] = []
+        self.entries: List[Tuple[str, int, int]] = []  # (record_id, first line, line count)
+        self.size = 0
+
+    def add(self, record_id: str, lines: List[bytes]):
+        self.entries.append((record_id, len(self.lines), len(lines)))
+        self.lines.extend(lines)
+        self.size += sum(len(line) + 1 for line in lines)
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class ShardedNdjsonSink:
+    """
+    Buffers NDJSON records per folder (endpoint and grad year) and writes them as shard files bounded by record
+    count and size. A manifest per folder maps each record ID to [shard blob, first line, line count] so single
+    records can still be found and removed. When a record is written again, its old copy is removed from the
+    previous shard on flush so the external tables never see duplicates. Folders are tagged with a group so
+    endpoints processed at the same time can be flushed separately.
+    """
+    def __init__(
+            self,
+            get_storage: Callable[[], StorageBackend],
+            max_records: int = SHARD_MAX_RECORDS,
+            max_bytes: int = SHARD_MAX_BYTES,
+            upload_pool: Union[UploadPool, None] = None
+    ):
+        # A provider rather than a backend so a cloud client is only created once something is read or written
+        self._get_storage = get_storage
+        self._upload_pool = upload_pool
+        self._max_records = max_records
+        self._max_bytes = max_bytes
+        self._run_id = f"{datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%S')}_{uuid4().hex[:6]}"
+        self._shard_sequence = 0
+        self._buffers: Dict[Tuple[str, str], _ShardBuffer] = {}
+        self._manifests: Dict[Tuple[str, str], dict] = {}
+        self._superseded: Dict[Tuple[str, str], Dict[str, list]] = {}
+        self._groups: Dict[Tuple[str, str], Union[str, None]] = {}
+        self._compression: Dict[Tuple[str, str], Union[str, None]] = {}
+        # Groups that have written a shard since they were last flushed
+        self._written_groups = set()
+        self._lock = RLock()
+
+    @staticmethod
+    def _manifest_blob_name(folder: str, prefix: str) -> str:
+        # Kept out of the data folders so the external tables never read it
+        return folder.replace("overgrad/", "overgrad/_manifests/", 1) + f"/{prefix}_manifest.json"
+
+    def _download(self, blob_name: str) -> Union[bytes, None]:
+        return self._get_storage().download(blob_name)
+
+    def _upload(self, blob_name: str, content: bytes):
+        self._get_storage().upload(blob_name, content)
+
+    def _manifest(self, key: Tuple[str, str]) -> dict:
+        with self._lock:
+            if key not in self._manifests:
+                content = self._download(self._manifest_blob_name(*key))
+                self._manifests[key] = serializers.loads(content) if content else {}
+            return self._manifests[key]
+
+    def add(
+            self,
+            folder: str,
+            prefix: str,
+            record_id,
+            lines: List[bytes],
+            group: Union[str, None] = None,
+            compression: Union[str, None] = None
+    ):
+        key = (folder, prefix)
+        record_id = str(record_id)
+        with self._lock:
+            self._groups[key] = group
+            self._compression[key] = compression
+            buffer = self._buffers.setdefault(key, _ShardBuffer())
+            buffer.add(record_id, lines)
+            full = len(buffer) >= self._max_records or buffer.size >= self._max_bytes
+        if full:
+            self._write_shard(key)
+
+    def _write_shard(self, key: Tuple[str, str]):
+        with self._lock:
+            buffer = self._buffers.pop(key, None)
+            if not buffer:
+                return
+            self._shard_sequence += 1
+            sequence = self._shard_sequence
+            self._written_groups.add(self._groups.get(key))
+        folder, prefix = key
+        compression = self._compression.get(key)
+        extension = serializers.NDJSON_EXTENSIONS[compression]
+        blob_name = f"{folder}/{prefix}_shard_{self._run_id}_{sequence:05d}{extension}"
+        content = serializers.encode_ndjson(buffer.lines, compression)
+        if self._upload_pool is not None:
+            self._upload_pool.submit(blob_name, content, self._groups.get(key))
+        else:
+            self._upload(blob_name, content)
+
+        manifest = self._manifest(key)
+        with self._lock:
+            superseded = self._superseded.setdefault(key, {})
+            for record_id, first_line, line_count in buffer.entries:
+                previous = manifest.get(record_id)
+                if previous is not None and previous[0] != blob_name:
+                    superseded.setdefault(previous[0], []).append(previous)
+                manifest[record_id] = [blob_name, first_line, line_count]
+        logging.debug(f"Wrote {len(buffer)} records to {blob_name}")
+
+    def _rewrite_shard(self, key: Tuple[str, str], shard: str, removed_entries: list):
+        """Rewrites a shard without the removed line ranges and shifts the manifest entries that remain in it"""
+        manifest = self._manifest(key)
+        content = self._download(shard)
+        if content is None:
+            return
+        # Shards keep the compression they were written with, even if the endpoint's has changed since
+        compression = "gzip" if shard.endswith(".gz") else None
+        lines = serializers.decode_ndjson(content, compression).split(b"\n")
+        dropped = set()
+        for _, first_line, line_count in removed_entries:
+            dropped.update(range(first_line, first_line + line_count))
+        kept_lines = [line for i, line in enumerate(lines) if i not in dropped]
+
+        remaining = [(record_id, entry) for record_id, entry in manifest.items() if entry[0] == shard]
+        for record_id, entry in remaining:
+            entry[1] -= sum(1 for line in dropped if line < entry[1])
+
+        if kept_lines:
+            self._upload(shard, serializers.encode_ndjson(kept_lines, compression))
+        else:
+            try:
+                self._get_storage().delete([shard])
+            except Exception as e:
+                logging.warning(f"Unable to delete empty shard {shard}: {e}")
+
+    def _save_manifest(self, key: Tuple[str, str]):
+        content = json.dumps(self._manifests[key]).encode("utf-8")
+        self._upload(self._manifest_blob_name(*key), content)
+
+    def wrote_shards(self, groups: Iterable) -> bool:
+        """Whether any of `groups` has written a shard since it was last flushed"""
+        with self._lock:
+            return any(group in self._written_groups for group in groups)
+
+    def flush(self, groups: Union[Iterable, None] = None):
+        """
+        Writes out buffered records, removes superseded copies and saves the touched manifests for the folders in
+        `groups`, or for all folders if no groups are given
+        """
+        with self._lock:
+            keys = {
+                key for key in set(self._buffers) | set(self._superseded)
+                if groups is None or self._groups.get(key) in groups
+            }
+        for key in keys:
+            self._write_shard(key)
+        if self._upload_pool is not None:
+            # Shards must be confirmed before they are rewritten or referenced by a saved manifest
+            self._upload_pool.join(None if groups is None else {self._groups.get(key) for key in keys})
+        for key in keys:
+            with self._lock:
+                shards = self._superseded.pop(key, {})
+            for shard, entries in shards.items():
+                self._rewrite_shard(key, shard, entries)
+            self._save_manifest(key)
+        with self._lock:
+            if groups is None:
+                self._written_groups.clear()
+            else:
+                self._written_groups.difference_update(groups)
+
+    def remove(self, folder: str, prefix: str, record_ids: Iterable) -> set:
+        """Removes records from their shards; returns the IDs that are not in the manifest"""
+        key = (folder, prefix)
+        manifest = self._manifest(key)
+        not_found = set()
+        by_shard: Dict[str, list] = {}
+        for record_id in record_ids:
+            entry = manifest.pop(str(record_id), None)
+            if entry is None:
+                not_found.add(record_id)
+            else:
+                by_shard.setdefault(entry[0], []).append(entry)
+        for shard, entries in by_shard.items():
+            self._rewrite_shard(key, shard, entries)
+        if by_shard:
+            self._save_manifest(key)
+        return not_found
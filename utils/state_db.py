@@ -0,0 +1,54 @@
+"""
+The SQLite files under STATE_DIR that keep the connector's state between runs: checkpoints, watermarks, the hash
+index, the university cache and the API cache index. Each store holds one table in its own file and reaches it
+through a StateDB, which creates the file and the table, adds columns introduced since the file was created and
+serializes access so the store can be shared between threads.
+"""
+from contextlib import contextmanager
+import os
+import sqlite3
+from threading import Lock
+from typing import Dict, Generator, Iterable, List, Union
+
+
+class StateDB:
+    def __init__(self, path: str, table: str, columns: str, added_columns: Union[None, Dict[str, str]] = None):
+        """
+        `columns` is the table's column definitions as of now; `added_columns` maps the name of each column added
+        since the first version to its definition, usually with the DEFAULT that older rows should get
+        """
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._lock = Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._connection:
+            self._connection.execute(f"CREATE TABLE IF NOT EXISTS {table} ({columns})")
+            existing = {row[1] for row in self._connection.execute(f"PRAGMA table_info({table})")}
+            for name, definition in (added_columns or {}).items():
+                if name not in existing:
+                    self._connection.execute(f"ALTER TABLE {table} ADD COLUMN {name} {definition}")
+
+    def fetchone(self, sql: str, parameters: Iterable = ()) -> Union[None, tuple]:
+        with self._lock:
+            return self._connection.execute(sql, tuple(parameters)).fetchone()
+
+    def fetchall(self, sql: str, parameters: Iterable = ()) -> List[tuple]:
+        with self._lock:
+            return self._connection.execute(sql, tuple(parameters)).fetchall()
+
+    def execute(self, sql: str, parameters: Iterable = ()) -> None:
+        with self._lock, self._connection:
+            self._connection.execute(sql, tuple(parameters))
+
+    def executemany(self, sql: str, rows: Iterable) -> None:
+        with self._lock, self._connection:
+            self._connection.executemany(sql, rows)
+
+    @contextmanager
+    def transaction(self) -> Generator[sqlite3.Connection, None, None]:
+        """Holds the lock for a read followed by a write; commits on success and rolls back on an exception"""
+        with self._lock, self._connection:
+            yield self._connection
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
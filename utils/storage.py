@@ -0,0 +1,255 @@
+"""
+Where the connector's output files go. STORAGE_BACKEND picks one of:
+
+    gcs     Google Cloud Storage, in the BUCKET bucket (the default)
+    local   A directory on disk, LOCAL_STORAGE_DIR; for offline runs and replaying captured API data
+    memory  A dict in this process; for measuring fetch and transform throughput without any I/O
+
+Every backend stores bytes under the same blob names, so the workflows write through `storage()` without knowing
+which one is in use.
+"""
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+import logging
+import os
+from threading import Lock, get_ident
+from typing import Dict, Iterable, List, Sequence, Set, Union
+
+from utils import batch_delete
+from utils import clients
+from utils.batch_delete import DeleteCounts
+
+
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "gcs")
+LOCAL_STORAGE_DIR = os.getenv("LOCAL_STORAGE_DIR", "output")
+LOCAL_FSYNC_BATCH = int(os.getenv("LOCAL_FSYNC_BATCH", 256))
+
+
+class StorageBackend(ABC):
+    name = None
+
+    @abstractmethod
+    def upload(self, blob_name: str, content: bytes) -> None:
+        pass
+
+    @abstractmethod
+    def download(self, blob_name: str) -> Union[bytes, None]:
+        """The blob's content, or None if it does not exist"""
+        pass
+
+    @abstractmethod
+    def delete(self, blob_names: Sequence[str]) -> DeleteCounts:
+        """Deletes blobs; blobs that do not exist are counted and listed as missing"""
+        pass
+
+    @abstractmethod
+    def list(self, prefix: str, extension: Union[None, str] = None) -> List[str]:
+        pass
+
+    @abstractmethod
+    def move(self, blob_name: str, new_name: str) -> None:
+        """Renames a blob, replacing any blob already under the new name"""
+        pass
+
+    def flush(self) -> None:
+        """Makes everything uploaded so far durable"""
+
+
+class GcsStorage(StorageBackend):
+    name = "gcs"
+
+    def __init__(self, bucket: str):
+        self._bucket = bucket
+
+    def upload(self, blob_name: str, content: bytes) -> None:
+        clients.cloud_storage().load_in_memory_file_to_cloud(self._bucket, blob_name, BytesIO(content))
+
+    def download(self, blob_name: str) -> Union[bytes, None]:
+        from google.api_core.exceptions import NotFound
+        # CloudStorageClient has no method for downloading arbitrary blobs
+        blob = clients.gcs_client().bucket(self._bucket).blob(blob_name)
+        try:
+            return blob.download_as_bytes()
+        except NotFound:
+            return None
+
+    def delete(self, blob_names: Sequence[str]) -> DeleteCounts:
+        return batch_delete.delete_blobs(clients.gcs_client(), self._bucket, blob_names)
+
+    def list(self, prefix: str, extension: Union[None, str] = None) -> List[str]:
+        return [blob.name for blob in clients.cloud_storage().list_blobs(self._bucket, prefix, extension)]
+
+    def move(self, blob_name: str, new_name: str) -> None:
+        # A copy within the bucket happens server side, so the content is never downloaded
+        bucket = clients.gcs_client().bucket(self._bucket)
+        bucket.copy_blob(bucket.blob(blob_name), bucket, new_name)
+        bucket.delete_blob(blob_name)
+
+
+class LocalStorage(StorageBackend):
+    """
+    Blobs are files under `root`. Each file is written to a temporary name and renamed into place, so readers never
+    see a partial file. Instead of an fsync per file, written files and their directories are fsynced in batches
+    of `fsync_batch` and on flush; a crash can lose the files written since the last batch, never corrupt one.
+    """
+    name = "local"
+
+    def __init__(self, root: str = LOCAL_STORAGE_DIR, fsync_batch: int = LOCAL_FSYNC_BATCH):
+        self._root = root
+        self._fsync_batch = fsync_batch
+        self._unsynced: Set[str] = set()
+        self._directories: Set[str] = set()
+        self._lock = Lock()
+
+    def _path(self, blob_name: str) -> str:
+        return os.path.join(self._root, *blob_name.split("/"))
+
+    def upload(self, blob_name: str, content: bytes) -> None:
+        path = self._path(blob_name)
+        directory = os.path.dirname(path)
+        if directory not in self._directories:
+            os.makedirs(directory, exist_ok=True)
+            self._directories.add(directory)
+        temp_path = f"{path}.{os.getpid()}.{get_ident()}.tmp"
+        with open(temp_path, "wb") as f:
+            f.write(content)
+        os.replace(temp_path, path)
+        with self._lock:
+            self._unsynced.add(path)
+            full = len(self._unsynced) >= self._fsync_batch
+        if full:
+            self.flush()
+
+    def download(self, blob_name: str) -> Union[bytes, None]:
+        try:
+            with open(self._path(blob_name), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def delete(self, blob_names: Sequence[str]) -> DeleteCounts:
+        deleted, missing = 0, []
+        directories = set()
+        for blob_name in blob_names:
+            path = self._path(blob_name)
+            try:
+                os.remove(path)
+                deleted += 1
+                directories.add(os.path.dirname(path))
+            except FileNotFoundError:
+                missing.append(blob_name)
+        with self._lock:
+            self._unsynced.difference_update(self._path(blob_name) for blob_name in blob_names)
+        _fsync_directories(directories)
+        return DeleteCounts(deleted, len(missing), tuple(missing))
+
+    def list(self, prefix: str, extension: Union[None, str] = None) -> List[str]:
+        # The prefix may end part way through a file name, so walk its directory and match whole blob names
+        directory = os.path.dirname(self._path(prefix))
+        blob_names = []
+        for dirpath, _, filenames in os.walk(directory):
+            relative = os.path.relpath(dirpath, self._root).replace(os.sep, "/")
+            for filename in filenames:
+                blob_name = f"{relative}/{filename}"
+                if filename.endswith(".tmp") or not blob_name.startswith(prefix):
+                    continue
+                if extension is None or blob_name.endswith(extension):
+                    blob_names.append(blob_name)
+        return sorted(blob_names)
+
+    def move(self, blob_name: str, new_name: str) -> None:
+        path, new_path = self._path(blob_name), self._path(new_name)
+        directory = os.path.dirname(new_path)
+        if directory not in self._directories:
+            os.makedirs(directory, exist_ok=True)
+            self._directories.add(directory)
+        os.replace(path, new_path)
+        with self._lock:
+            self._unsynced.discard(path)
+            self._unsynced.add(new_path)
+        _fsync_directories({os.path.dirname(path)})
+
+    def flush(self) -> None:
+        with self._lock:
+            paths, self._unsynced = self._unsynced, set()
+        if not paths:
+            return
+        with ThreadPoolExecutor(max_workers=8, thread_name_prefix="fsync") as executor:
+            list(executor.map(_fsync_file, paths))
+        _fsync_directories({os.path.dirname(path) for path in paths})
+        logging.debug(f"Synced {len(paths)} file(s) under {self._root}")
+
+
+def _fsync_file(path: str) -> None:
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except FileNotFoundError:
+        return
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _fsync_directories(directories: Iterable[str]) -> None:
+    # Makes renames and removals durable; directories cannot be opened for fsync on Windows
+    if os.name == "nt":
+        return
+    for directory in directories:
+        _fsync_file(directory)
+
+
+class MemoryStorage(StorageBackend):
+    name = "memory"
+
+    def __init__(self):
+        self.blobs: Dict[str, bytes] = {}
+        self._lock = Lock()
+
+    def upload(self, blob_name: str, content: bytes) -> None:
+        with self._lock:
+            self.blobs[blob_name] = content
+
+    def download(self, blob_name: str) -> Union[bytes, None]:
+        with self._lock:
+            return self.blobs.get(blob_name)
+
+    def delete(self, blob_names: Sequence[str]) -> DeleteCounts:
+        with self._lock:
+            missing = tuple(blob_name for blob_name in blob_names if self.blobs.pop(blob_name, None) is None)
+        return DeleteCounts(len(blob_names) - len(missing), len(missing), missing)
+
+    def move(self, blob_name: str, new_name: str) -> None:
+        with self._lock:
+            self.blobs[new_name] = self.blobs.pop(blob_name)
+
+    def list(self, prefix: str, extension: Union[None, str] = None) -> List[str]:
+        with self._lock:
+            return sorted(
+                blob_name for blob_name in self.blobs
+                if blob_name.startswith(prefix) and (extension is None or blob_name.endswith(extension))
+            )
+
+
+_lock = Lock()
+_storage = None
+
+
+def create_storage(backend: str = STORAGE_BACKEND) -> StorageBackend:
+    if backend == "gcs":
+        return GcsStorage(os.getenv("BUCKET"))
+    if backend == "local":
+        return LocalStorage()
+    if backend == "memory":
+        return MemoryStorage()
+    raise ValueError(f"Unknown STORAGE_BACKEND: {backend}")
+
+
+def storage() -> StorageBackend:
+    """The process-wide storage backend chosen by STORAGE_BACKEND, created on first use"""
+    global _storage
+    with _lock:
+        if _storage is None:
+            _storage = create_storage()
+    return _storage
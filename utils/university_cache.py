@@ -0,0 +1,40 @@
+import os
+from time import time
+from typing import Iterable
+
+from utils.config import STATE_DIR
+from utils.state_db import StateDB
+
+
+UNIVERSITY_CACHE_PATH = os.getenv("UNIVERSITY_CACHE_PATH", os.path.join(STATE_DIR, "university_cache.db"))
+UNIVERSITY_CACHE_TTL_DAYS = float(os.getenv("UNIVERSITY_CACHE_TTL_DAYS", 30))
+
+
+class UniversityCache:
+    """
+    SQLite cache of the IDs of universities that have already been loaded to cloud storage, keyed by university ID.
+    Entries older than the TTL are treated as missing so they get refreshed.
+    """
+    def __init__(self, path: str = UNIVERSITY_CACHE_PATH, ttl_days: float = UNIVERSITY_CACHE_TTL_DAYS):
+        self._ttl_seconds = ttl_days * 86400
+        self._db = StateDB(path, "universities", "id INTEGER PRIMARY KEY, fetched_at REAL")
+
+    def get_stale_ids(self, university_ids: Iterable) -> set:
+        """Returns the IDs that are not in the cache or have expired"""
+        university_ids = set(university_ids)
+        cutoff = time() - self._ttl_seconds
+        fresh_ids = {
+            row[0] for row in self._db.fetchall("SELECT id FROM universities WHERE fetched_at >= ?", (cutoff,))
+        }
+        return university_ids - fresh_ids
+
+    def add(self, university_ids: Iterable):
+        """Records universities as loaded; call only once their uploads are confirmed"""
+        fetched_at = time()
+        self._db.executemany(
+            "INSERT OR REPLACE INTO universities (id, fetched_at) VALUES (?, ?)",
+            ((university_id, fetched_at) for university_id in university_ids)
+        )
+
+    def close(self):
+        self._db.close()
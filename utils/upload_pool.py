@@ -0,0 +1,78 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+import logging
+import os
+from threading import Condition, Lock
+from typing import Callable, Dict, Iterable, List, Union
+
+from tenacity import retry, stop_after_attempt, wait_exponential
+
+
+UPLOAD_WORKERS = int(os.getenv("UPLOAD_WORKERS", 8))
+UPLOAD_MAX_IN_FLIGHT_BYTES = int(os.getenv("UPLOAD_MAX_IN_FLIGHT_BYTES", 64 * 1024 * 1024))
+UPLOAD_RETRIES = int(os.getenv("UPLOAD_RETRIES", 3))
+
+
+class UploadError(Exception):
+    pass
+
+
+class UploadPool:
+    """
+    Runs uploads on background threads so fetching and uploading overlap. `submit` blocks while the bytes waiting
+    to be uploaded would exceed `max_in_flight_bytes`, which keeps memory capped. Failed uploads are retried;
+    `join` waits for everything submitted so far and raises if any upload still failed. Uploads can be tagged with
+    a group so endpoints processed at the same time only wait for their own uploads.
+    """
+    def __init__(
+            self,
+            upload: Callable[[str, bytes], None],
+            max_workers: int = UPLOAD_WORKERS,
+            max_in_flight_bytes: int = UPLOAD_MAX_IN_FLIGHT_BYTES,
+            retries: int = UPLOAD_RETRIES
+    ):
+        self._upload = retry(
+            stop=stop_after_attempt(max(1, retries)),
+            wait=wait_exponential(multiplier=1, max=30),
+            reraise=True
+        )(upload)
+        self._executor = ThreadPoolExecutor(max_workers=max(1, max_workers), thread_name_prefix="upload")
+        self._max_in_flight_bytes = max_in_flight_bytes
+        self._in_flight_bytes = 0
+        self._condition = Condition()
+        self._futures: Dict[Union[str, None], List[Future]] = {}
+        self._futures_lock = Lock()
+
+    def _run(self, blob_name: str, content: bytes):
+        try:
+            self._upload(blob_name, content)
+        finally:
+            with self._condition:
+                self._in_flight_bytes -= len(content)
+                self._condition.notify_all()
+
+    def submit(self, blob_name: str, content: bytes, group: Union[str, None] = None) -> None:
+        size = len(content)
+        with self._condition:
+            # A single object larger than the limit is still let through once nothing else is in flight
+            self._condition.wait_for(
+                lambda: self._in_flight_bytes == 0 or self._in_flight_bytes + size <= self._max_in_flight_bytes
+            )
+            self._in_flight_bytes += size
+        future = self._executor.submit(self._run, blob_name, content)
+        future.blob_name = blob_name
+        with self._futures_lock:
+            self._futures.setdefault(group, []).append(future)
+
+    def join(self, groups: Union[Iterable, None] = None) -> None:
+        """Waits for the uploads in `groups`, or for all uploads if no groups are given"""
+        with self._futures_lock:
+            groups = list(self._futures.keys()) if groups is None else groups
+            futures = [future for group in groups for future in self._futures.pop(group, [])]
+        failed = []
+        for future in futures:
+            error = future.exception()
+            if error is not None:
+                logging.error(f"Failed to upload {future.blob_name}: {error}")
+                failed.append(future.blob_name)
+        if failed:
+            raise UploadError(f"{len(failed)} upload(s) failed, including {failed[0]}")
@@ -0,0 +1,80 @@
+from datetime import datetime, timedelta, timezone
+import os
+from threading import Lock
+from time import time
+from typing import Union
+
+from utils.config import STATE_DIR
+from utils.state_db import StateDB
+
+
+WATERMARK_PATH = os.getenv("WATERMARK_PATH", os.path.join(STATE_DIR, "watermarks.db"))
+# Subtracted from the watermark when requesting updates, to absorb clock skew between the API and this machine
+WATERMARK_OVERLAP_SECONDS = int(os.getenv("WATERMARK_OVERLAP_SECONDS", 300))
+
+
+def parse_timestamp(value: str) -> datetime:
+    """Parses an ISO 8601 timestamp; ones without an offset are taken to be UTC. Raises ValueError otherwise."""
+    if not isinstance(value, str):
+        raise ValueError(f"Expected an ISO 8601 timestamp, got {value!r}")
+    parsed = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    return parsed if parsed.tzinfo is not None else parsed.replace(tzinfo=timezone.utc)
+
+
+def format_timestamp(value: datetime) -> str:
+    return value.astimezone(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+class WatermarkStore:
+    """
+    SQLite store of the latest `updated_at` loaded per (endpoint, grad year). A watermark only moves forward, and
+    only once the records it covers have been committed. Safe to share between threads.
+    """
+    def __init__(self, path: str = WATERMARK_PATH):
+        self._db = StateDB(
+            path,
+            "watermarks",
+            "endpoint TEXT, grad_year TEXT, updated_at TEXT, saved_at REAL, PRIMARY KEY (endpoint, grad_year)"
+        )
+
+    def get(self, endpoint: str, grad_year: Union[None, str]) -> Union[None, datetime]:
+        row = self._db.fetchone(
+            "SELECT updated_at FROM watermarks WHERE endpoint = ? AND grad_year = ?", (endpoint, grad_year or "")
+        )
+        return parse_timestamp(row[0]) if row is not None else None
+
+    def updated_after(self, endpoint: str, grad_year: Union[None, str]) -> Union[None, str]:
+        """
+        The updated_after filter for the next incremental run, or None if the endpoint has no watermark yet. The
+        API filters by date, so this is the UTC date of the watermark less the overlap, as YYYY-MM-DD; the hash
+        index skips the records of that day that were already loaded.
+        """
+        watermark = self.get(endpoint, grad_year)
+        if watermark is None:
+            return None
+        overlapped = watermark - timedelta(seconds=WATERMARK_OVERLAP_SECONDS)
+        return overlapped.astimezone(timezone.utc).strftime("%Y-%m-%d")
+
+    def advance(self, endpoint: str, grad_year: Union[None, str], updated_at: datetime) -> None:
+        with self._db.transaction() as connection:
+            row = connection.execute(
+                "SELECT updated_at FROM watermarks WHERE endpoint = ? AND grad_year = ?", (endpoint, grad_year or "")
+            ).fetchone()
+            if row is not None and parse_timestamp(row[0]) >= updated_at:
+                return
+            connection.execute(
+                "INSERT OR REPLACE INTO watermarks VALUES (?, ?, ?, ?)",
+                (endpoint, grad_year or "", format_timestamp(updated_at), time())
+            )
+
+
+_store = None
+_store_lock = Lock()
+
+
+def watermark_store() -> WatermarkStore:
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = WatermarkStore()
+    return _store
@@ -1,48 +1,76 @@
 import logging
 import os
-from typing import Union
+import random
+from time import perf_counter
+from typing import List, Union
 
-from entities.endpoints import Endpoint
+from entities.endpoints import CustomField, Endpoint
 from entities.overgrad_api import OvergradAPIPaginator
+from utils import batch_delete
+from utils import clients
+from utils import helpers
+from utils import id_sets
+from utils import serializers
+from utils.api_id_index import ApiIdIndex
+from utils.storage import storage
 
-from gbq_connector import BigQueryClient
-from gbq_connector import CloudStorageClient
-from google.api_core.exceptions import NotFound
+import numpy as np
 
-gbq = BigQueryClient()
-cloud_storage = CloudStorageClient()
-
-bucket = os.getenv("BUCKET")
 dataset = os.getenv("GBQ_DATASET")
 project = os.getenv("GBQ_PROJECT")
 
-
-def _delete_record(endpoint: Endpoint, record_id: str, year: str):
-    record_path = f"overgrad/{endpoint.gcs_folder}/{year}/{endpoint.file_name_prefix}_{record_id}.ndjson"
-    cloud_storage.delete_file(bucket, record_path)
-    custom_fields = endpoint.custom_field
-    if custom_fields is not None:
-        try:
-            custom_field_record_path = f"overgrad/{custom_fields.gcs_folder}/{year}/{custom_fields.file_name_prefix}_{record_id}.ndjson"
-            cloud_storage.delete_file(bucket, custom_field_record_path)
-            logging.info(f"Deleted {endpoint.name} record and custom fields")
-        except NotFound:
-            # If there are no custom field records, do nothing
-            logging.info(f"Deleted {endpoint.name} record; No custom fields were found")
-    else:
-        logging.info(f"Deleted {endpoint.name} record; No custom fields were found")
-
-
-def _get_dw_student_ids(year: str) -> Union[set, None]:
+DW_PAGE_SIZE = int(os.getenv("DELETE_RECORDS_DW_PAGE_SIZE", 50000))
+DELETE_MAX_RATIO = float(os.getenv("DELETE_MAX_RATIO", 0.2))
+DELETE_SAMPLE_PAGES = int(os.getenv("DELETE_SAMPLE_PAGES", 3))
+
+
+class DeleteThresholdError(Exception):
+    pass
+
+
+def _delete_record_files(
+        endpoint: Union[Endpoint, CustomField],
+        record_ids: List[str],
+        year: str
+) -> batch_delete.DeleteCounts:
+    """
+    Deletes the single files of records under the endpoint's current extension. Files written before the
+    endpoint's compression changed keep their old extension, so only files not found under the current name are
+    tried under the other ones; files found under no name are counted as missing.
+    """
+    folder = helpers.gcs_folder(endpoint, year)
+    extension = serializers.NDJSON_EXTENSIONS[endpoint.compression]
+    counts = storage().delete(
+        [f"{folder}/{endpoint.file_name_prefix}_{record_id}{extension}" for record_id in record_ids]
+    )
+    deleted = counts.deleted
+    missing = counts.missing_blobs
+    for other_extension in set(serializers.NDJSON_EXTENSIONS.values()) - {extension}:
+        if not missing:
+            break
+        other_counts = storage().delete([blob_name[:-len(extension)] + other_extension for blob_name in missing])
+        deleted += other_counts.deleted
+        missing = tuple(blob_name[:-len(other_extension)] + extension for blob_name in other_counts.missing_blobs)
+    return batch_delete.DeleteCounts(deleted, len(missing), missing)
+
+
+def _stream_query_ids(query: str) -> Union[np.ndarray, None]:
+    """
+    Streams the single ID column of a query page by page into a sorted int64 array, so only one page of rows is
+    held as Python objects at a time
+    """
+    rows = clients.bigquery_client().query(query).result(page_size=DW_PAGE_SIZE)
+    chunks = [id_sets.to_id_array(row[0] for row in page) for page in rows.pages]
+    ids = id_sets.concat_id_arrays(chunks)
+    return ids if len(ids) else None
+
+
+def _get_dw_student_ids(year: str) -> Union[np.ndarray, None]:
     query = f"SELECT overgrad_student_id FROM `{project}.{dataset}.stg_og__students` where graduation_year = {year}"
-    df = gbq.query(query)
-    if df is not None:
-        return set(str(x) for x in df["overgrad_student_id"].to_list())
-    else:
-        return None
+    return _stream_query_ids(query)
 
 
-def _get_dw_non_student_ids(endpoint: Endpoint, grad_year: str) -> Union[set, None]:
+def _get_dw_non_student_ids(endpoint: Endpoint, grad_year: str) -> Union[np.ndarray, None]:
     id_field = "overgrad_application_id" if endpoint.name == "admissions" else "overgrad_following_id"
     query = f"""
         SELECT {id_field} FROM `{project}.{dataset}.stg_og__{endpoint.name}` as data
@@ -50,16 +78,48 @@ def _get_dw_non_student_ids(endpoint: Endpoint, grad_year: str) -> Union[set, No
         on data.overgrad_student_id = students.overgrad_student_id
         where students.graduation_year = {grad_year}
         """
-    df = gbq.query(query)
-    if df is not None:
-        return set(str(x) for x in df[id_field].to_list())
-    else:
-        return None
-
-
-def run_delete_records_workflow(api: OvergradAPIPaginator, endpoint: Endpoint, grad_year: str) -> None:
+    return _stream_query_ids(query)
+
+
+def _api_ids_unchanged(api: OvergradAPIPaginator, known_ids: np.ndarray) -> bool:
+    """
+    Cheap check that the API still returns the IDs of the last full scan: total_count must match and every ID on
+    page 1 and on a few randomly sampled pages must already be known
+    """
+    first_page = api.fetch_page(1)
+    if api.total_count != len(known_ids):
+        logging.info(f"{api.endpoint} total_count changed from {len(known_ids)} to {api.total_count}")
+        return False
+    other_pages = list(range(2, (api.total_pages or 1) + 1))
+    sampled_pages = random.sample(other_pages, min(len(other_pages), max(0, DELETE_SAMPLE_PAGES - 1)))
+    for page, payload in [(1, first_page)] + [(page, api.fetch_page(page)) for page in sampled_pages]:
+        page_ids = id_sets.to_id_array(record["id"] for record in payload["data"])
+        if not np.isin(page_ids, known_ids, assume_unique=True).all():
+            logging.info(f"{api.endpoint} page {page} has IDs that were not in the last full scan")
+            return False
+    return True
+
+
+def _get_api_ids(api: OvergradAPIPaginator, endpoint: Endpoint, grad_year: str, incremental: bool) -> tuple:
+    """Returns (API IDs, whether they came from a full scan)"""
+    if incremental:
+        known_ids = ApiIdIndex().load(endpoint.name, grad_year)
+        if known_ids is not None and _api_ids_unchanged(api, known_ids):
+            logging.info(f"{endpoint.name} ({grad_year}) matches the last full scan; skipping the re-scan")
+            return known_ids, False
+    return id_sets.to_id_array(record["id"] for record in api.call_endpoint()), True
+
+
+def run_delete_records_workflow(
+        api: OvergradAPIPaginator,
+        endpoint: Endpoint,
+        grad_year: str,
+        dry_run: bool = False,
+        incremental: bool = False
+) -> None:
 
     logging.info(f"Running deletion workflow for {endpoint.name}")
+    start = perf_counter()
 
     ids_from_dw = None
     if endpoint.name == "students":
@@ -68,16 +128,54 @@ def run_delete_records_workflow(api: OvergradAPIPaginator, endpoint: Endpoint, g
         ids_from_dw = _get_dw_non_student_ids(endpoint, grad_year)
 
     if ids_from_dw is not None:
-        ids_from_api = set()
-        for record in api.call_endpoint():
-            ids_from_api.add(str(record["id"]))
-
-        missing_ids = list(ids_from_dw - ids_from_api)
-
-        if missing_ids:
+        ids_from_api, full_scan = _get_api_ids(api, endpoint, grad_year, incremental)
+
+        missing_ids = [str(record_id) for record_id in id_sets.missing_ids(ids_from_dw, ids_from_api)]
+        logging.info(
+            f"Compared {len(ids_from_dw)} DW and {len(ids_from_api)} API {endpoint.name} IDs in "
+            f"{perf_counter() - start:.1f}s"
+        )
+
+        # A partial API response looks like a mass deletion; refuse instead of wiping the warehouse
+        delete_ratio = len(missing_ids) / len(ids_from_dw)
+        if delete_ratio > DELETE_MAX_RATIO:
+            message = (
+                f"{len(missing_ids)} of {len(ids_from_dw)} {endpoint.name} ({grad_year}) records would be deleted, "
+                f"above DELETE_MAX_RATIO of {DELETE_MAX_RATIO}"
+            )
+            if not dry_run:
+                raise DeleteThresholdError(message)
+            logging.warning(f"{message}; a real run would stop here")
+        elif full_scan and not dry_run:
+            ApiIdIndex().save(endpoint.name, grad_year, ids_from_api)
+
+        if missing_ids and dry_run:
+            logging.info(f"Dry run; would delete {len(missing_ids)} {endpoint.name} record(s): {', '.join(missing_ids)}")
+        elif missing_ids:
             logging.info(f"Found {len(missing_ids)} record(s) to delete")
-            for record in missing_ids:
-                logging.info(f"Deleting {record}")
-                _delete_record(endpoint, record, grad_year)
+            delete_start = perf_counter()
+            # Records written in sharded mode are removed from their shards; the rest are single files
+            unsharded_ids = helpers.shard_sink.remove(
+                helpers.gcs_folder(endpoint, grad_year), endpoint.file_name_prefix, missing_ids
+            )
+            counts = _delete_record_files(endpoint, sorted(unsharded_ids), grad_year)
+            custom_counts = batch_delete.DeleteCounts(0, 0)
+            if endpoint.custom_field is not None:
+                unsharded_custom_ids = helpers.shard_sink.remove(
+                    helpers.gcs_folder(endpoint.custom_field, grad_year),
+                    endpoint.custom_field.file_name_prefix,
+                    missing_ids
+                )
+                # Records without custom fields have no custom field file; those are counted as missing
+                custom_counts = _delete_record_files(endpoint.custom_field, sorted(unsharded_custom_ids), grad_year)
+            helpers.hash_index().forget(helpers.gcs_folder(endpoint, grad_year), missing_ids)
+            if endpoint.custom_field is not None:
+                helpers.hash_index().forget(helpers.gcs_folder(endpoint.custom_field, grad_year), missing_ids)
+            logging.info(
+                f"Deleted {len(missing_ids)} {endpoint.name} record(s) in {perf_counter() - delete_start:.1f}s; "
+                f"{counts.deleted} file(s) deleted, "
+                f"{len(missing_ids) - len(unsharded_ids)} removed from shards; "
+                f"{custom_counts.deleted} custom field file(s) deleted"
+            )
         else:
             logging.info("No records to delete")
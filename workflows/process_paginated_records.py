@@ -1,9 +1,15 @@
+from datetime import datetime, timezone
 import logging
-from typing import List
+from time import perf_counter
+from typing import List, Tuple, Union
 
 from entities.endpoints import Endpoint
 from entities.overgrad_api import OvergradAPIPaginator
 from utils import helpers
+from utils.checkpoints import checkpoint_store
+from utils.metrics import metrics
+from utils.watermarks import parse_timestamp
+from utils.watermarks import watermark_store
 
 
 def _flatten_custom_fields(record: dict, endpoint: Endpoint) -> List[dict]:
@@ -52,40 +58,116 @@ def _process_custom_fields(record: dict, endpoint: Endpoint, grad_year: str):
         return len(filtered_custom_fields)
 
 
-def _flatten_nested_fields(parent_field_name: str, child_fields: dict) -> dict:
-    flattened_dict = {}
-    for field, value in child_fields.items():
-        flattened_name = f"{parent_field_name}_{field}"
-        flattened_dict[flattened_name] = value
-    return flattened_dict
+def _setup_checkpoints(
+        endpoint: Endpoint,
+        api: OvergradAPIPaginator,
+        university_id_queue: set,
+        folder_year: Union[None, str],
+        resume: bool,
+        run_start: datetime
+) -> Tuple:
+    """
+    Resumes from the last checkpoint if asked to, and saves a checkpoint whenever helpers.checkpoint_due says so,
+    once that page's uploads are confirmed. Output that cannot be resumed is never checkpointed.
 
+    Returns the store, the checkpoint key and when the run started: for a resumed run, when the run that saved the
+    checkpoint started, or None if that is not known.
+    """
+    store = checkpoint_store()
+    checkpoint_key = (api.endpoint, api.graduation_year, api.after_date)
+    if resume:
+        saved = store.get(*checkpoint_key)
+        if saved is not None:
+            last_page, university_ids, page_size, run_started_at = saved
+            logging.info(f"Resuming {endpoint.name} after page {last_page}")
+            api.start_after_page(last_page, page_size)
+            university_id_queue.update(university_ids)
+            run_start = datetime.fromtimestamp(run_started_at, timezone.utc) if run_started_at is not None else None
 
-def _process_nested_fields(record: dict, endpoint: Endpoint) -> None:
-    for nested_field in endpoint.nested_fields:
-        child_fields = record.pop(nested_field)
-        if child_fields:
-            flattened_fields = _flatten_nested_fields(nested_field, child_fields)
-            record.update(flattened_fields)
+    def save_checkpoint(page: int):
+        if helpers.checkpoint_due(endpoint, folder_year, page):
+            helpers.flush_cloud_storage(endpoint, folder_year)
+            store.save(
+                *checkpoint_key, page, university_id_queue, api.page_size,
+                run_start.timestamp() if run_start is not None else None
+            )
 
+    if helpers.checkpoints_supported():
+        api.on_page_complete = save_checkpoint
+    return store, checkpoint_key, run_start
 
-def run_record_processing(endpoint: Endpoint, api: OvergradAPIPaginator, university_id_queue: set, grad_year: str) -> None:
+
+def run_record_processing(
+        endpoint: Endpoint,
+        api: OvergradAPIPaginator,
+        university_id_queue: set,
+        grad_year: str,
+        resume: bool = False,
+        advance_watermark: bool = False
+) -> None:
+    """
+    With `advance_watermark`, the endpoint's watermark moves to the latest `updated_at` loaded once every record is
+    committed, but never past the time the run started: a record updated while the run was paging may sit on a
+    page fetched earlier. A resumed run uses the start of the run that saved the checkpoint, since it does not see
+    the pages before it. Pass it only when the run covered every update since the current watermark.
+    """
+    folder_year = grad_year if endpoint.has_grad_year else None
+    checkpoints, checkpoint_key, run_start = _setup_checkpoints(
+        endpoint, api, university_id_queue, folder_year, resume, datetime.now(timezone.utc)
+    )
+    if advance_watermark and run_start is None:
+        logging.warning(f"Not advancing the {endpoint.name} watermark; its checkpoint predates watermarks")
+        advance_watermark = False
     custom_field_count = 0
-    for record in api.call_endpoint():
-        if endpoint.nested_fields is not None:
-            _process_nested_fields(record, endpoint)
-        if endpoint.has_university_id:
-            uni_id = record.get("university_id")
-            if uni_id is not None:
-                university_id_queue.add(record.get("university_id"))
-        if endpoint.custom_field is not None:
-            count = _process_custom_fields(record, endpoint, grad_year)
-            if count is not None:
-                custom_field_count += count
-        cleaned_record = helpers.clean_record_fields(record, endpoint)
-        if endpoint.has_grad_year:
-            helpers.load_to_cloud_storage(cleaned_record, endpoint, grad_year)
-        else:
-            helpers.load_to_cloud_storage(cleaned_record, endpoint)
-    logging.info(f"Loaded {api.record_count} records from {endpoint.name}")
+    latest_update = None
+    # Per-record timings are kept locally and merged into the run metrics once the endpoint is done
+    stage_metrics = metrics.local(endpoint=endpoint.name)
+    try:
+        for record in api.call_endpoint():
+            start = perf_counter()
+            if endpoint.custom_field is not None:
+                count = _process_custom_fields(record, endpoint, grad_year)
+                if count is not None:
+                    custom_field_count += count
+                custom_fields_done = perf_counter()
+                stage_metrics.observe("custom_fields_seconds", custom_fields_done - start)
+                start = custom_fields_done
+            cleaned_record = endpoint.transform(record)
+            transformed = perf_counter()
+            stage_metrics.observe("transform_seconds", transformed - start)
+            updated_at = cleaned_record.get("updated_at") if advance_watermark else None
+            if updated_at is not None:
+                try:
+                    updated_at = parse_timestamp(updated_at)
+                except ValueError:
+                    logging.warning(f"Not advancing the {endpoint.name} watermark; {updated_at!r} is not a timestamp")
+                    advance_watermark = False
+                else:
+                    if latest_update is None or updated_at > latest_update:
+                        latest_update = updated_at
+            if endpoint.has_university_id:
+                uni_id = cleaned_record.get("university_id")
+                if uni_id is not None:
+                    university_id_queue.add(uni_id)
+            if endpoint.has_grad_year:
+                helpers.load_to_cloud_storage(cleaned_record, endpoint, grad_year)
+            else:
+                helpers.load_to_cloud_storage(cleaned_record, endpoint)
+            # Includes hashing, serializing and waiting for room in the upload queue
+            stage_metrics.observe("load_seconds", perf_counter() - transformed)
+    finally:
+        stage_metrics.flush()
+    helpers.flush_cloud_storage(endpoint, folder_year)
+    helpers.finish_output(endpoint, folder_year)
+    if advance_watermark and latest_update is not None:
+        watermark_store().advance(endpoint.name, folder_year, min(latest_update, run_start))
+    checkpoints.clear(*checkpoint_key)
+    label = f"{endpoint.name} ({folder_year})" if folder_year is not None else endpoint.name
+    written, skipped = helpers.pop_load_counts(endpoint, folder_year)
+    logging.info(f"Loaded {api.record_count} records from {label}; {written} written, {skipped} unchanged")
     if custom_field_count > 0:
-        logging.info(f"Loaded {custom_field_count} custom field rows from {endpoint.name}")
\ No newline at end of file
+        written, skipped = helpers.pop_load_counts(endpoint.custom_field, folder_year)
+        logging.info(
+            f"Loaded {custom_field_count} custom field rows from {label}; "
+            f"{written} record groups written, {skipped} unchanged"
+        )
\ No newline at end of file